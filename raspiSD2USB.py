@@ -25,7 +25,7 @@
 # and SD card is only needed for raspberry boot process 
 #
 # 1) Valid candidates for new root partition:
-#    a) filesystem type has to match
+#    a) filesystem type has to match (unless option --convert formats the target partition as f2fs or btrfs)
 #    b) target partition has to have enough space
 #    c) target partition has to be empty
 # 2) Backup SD card boot command file cmdline.txt to cmdline.txt.sd
@@ -35,10 +35,20 @@
 #
 # --- Notes: 
 #
-# 1) No data is deleted from any partition in any case
+# 1) No data is deleted from any partition in any case. Option --convert formats the selected empty target partition
 # 2) If something went wrong the saved file cmdline.txt.sd on /dev/mmcblk0p1 can be 
 #    copied to cmdline.txt and the original SD root partition will be used again on next boot
 # 3) If there are multiple USB disks connected the target device partition type has to be gpt instead of mbr 
+# 4) Options --exclude and --rules (e.g. preset raspios) exclude gitignore style patterns from the copy and
+#    the replication. Swap files are not copied but created with the same size on the target partition
+# 5) Option --iotune tunes I/O scheduler, read-ahead, mount options, discard and rootwait for the target
+#    device. All changes are shown as diff before they are written, --dry-run only shows them
+#
+# --- API:
+#
+# The module can be imported without side effects. detectPartitions(), collectEligiblePartitions(),
+# copyRootPartition(), updateBootConfiguration() and planIOTuning() return namedtuples and raise MigrationError.
+# Logging is not configured unless setupLogging() is called, main() is the command line interface.
 #
 #####################################################################################################
 # THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
@@ -57,6 +67,27 @@ import argparse
 import math
 import locale
 import traceback
+import stat
+import time
+import pipes
+import tempfile
+import multiprocessing
+import ctypes
+import ctypes.util
+import select
+import struct
+import errno
+import signal
+import shutil
+import threading
+import Queue
+import json
+import atexit
+import collections
+import array
+import bisect
+import mmap
+import difflib
 
 # various constants
 
@@ -86,6 +117,12 @@ except Exception,e:
 
 GIT_CODEVERSION = MYSELF + " V" + str(VERSION) + " " + GIT_DATE_ONLY + "/" + GIT_TIME_ONLY + " " + GIT_COMMIT_ONLY
 
+logger = logging.getLogger(MYNAME)
+logger.addHandler(logging.NullHandler())
+# events are logged independent of the log level
+eventLogger = logging.getLogger(MYNAME + ".events")
+eventLogger.setLevel(logging.INFO)
+
 # return big number human readable in KB, MB ...
 
 def asReadable(number):
@@ -108,9 +145,11 @@ def executeCommand(command, noRC=True):
 	rc = None
 	result = None
 	try:
+		start = time.time()
 		proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
 		result,error = proc.communicate()
 		rc = proc.returncode		
+		logEvent("command", command=command, rc=rc, seconds=round(time.time() - start, 3))
 
 		if rc != 0 and noRC:
 			raise Exception("Command '%s' failed with rc %d\nError message:\n%s" % (command, rc, error.rstrip()))
@@ -129,27 +168,39 @@ class MessageCatalog(object):
 
 	# locale.setlocale(locale.LC_ALL, '')
 
-	__locale = locale.getdefaultlocale()[0].upper().split("_")[0] 
+	# detected on first use and not when the module is imported
+	__locale = None
 
 # 	__locale = "DE"
 
-	if not __locale in ("DE"):
-		__locale = "EN"
+	@staticmethod
+	def __getLocale():
+		if MessageCatalog.__locale is None:
+			defaultLocale = locale.getdefaultlocale()[0]
+			detectedLocale = defaultLocale.upper().split("_")[0] if defaultLocale else "EN"
+			if not detectedLocale in ("DE"):
+				detectedLocale = "EN"
+			MessageCatalog.__locale = detectedLocale
+		return MessageCatalog.__locale
 
 	@staticmethod
 	def getLocalizedMessage(message, *messageArguments):
 		msgEyeCatcher={ "I": "---", "W": "!!!", "E": "???" }
-		if not MessageCatalog.__locale in message:
+		if not MessageCatalog.__getLocale() in message:
 			return message[MessageCatalog.MSG_UNDEFINED].format(message)
 		else:
-			msg=message[MessageCatalog.__locale].split(' ')
+			msg=message[MessageCatalog.__getLocale()].split(' ')
 			eyeCatcher=msgEyeCatcher[msg[0][-1]]
 			message=msg[0]+" " + eyeCatcher + " " + " ".join(msg[1:])
 			return message.format(*messageArguments)
 
+	@staticmethod
+	def getMessageId(message):
+		return message["EN"].split(' ')[0]
+
 	@staticmethod
 	def getDefaultLocale():
-		return MessageCatalog.__locale
+		return MessageCatalog.__getLocale()
 
 	@staticmethod
 	def setLocale(locale):
@@ -307,6 +358,114 @@ class MessageCatalog(object):
 				   "EN": "RSD0036W Target partition {0} already used in fstab. Commenting out this line",
 				   "DE": "RSD0036W Zielpartition {0} wird in der fstab schon benutzt. Die Zeile wird auskommentiert"
 	}
+	MSG_COPY_TUNING = {
+				   "EN": "RSD0037I Copy tuned with buffer size {0} and {1} concurrent copies (maximum {2})",
+				   "DE": "RSD0037I Kopie optimiert mit Puffergröße {0} und {1} parallelen Kopien (maximal {2})"
+	}
+	MSG_COPY_PROGRESS = {
+				   "EN": "RSD0038I Copied {0} of {1} with {2} concurrent copies",
+				   "DE": "RSD0038I {0} von {1} mit {2} parallelen Kopien kopiert"
+	}
+	MSG_PARTITION_WILL_BE_CONVERTED = {
+				   "EN": "RSD0039I Partition {0} with type {1} will be converted to {2}",
+				   "DE": "RSD0039I Partition {0} mit Typ {1} wird nach {2} konvertiert"
+	}
+	MSG_PARTITION_WILL_BE_FORMATTED = {
+				   "EN": "RSD0040W Partition {0} will be formatted as {1}",
+				   "DE": "RSD0040W Partition {0} wird als {1} formatiert"
+	}
+	MSG_CONVERSION_NOT_SUPPORTED = {
+				   "EN": "RSD0041E Conversion to {0} not possible: {1}",
+				   "DE": "RSD0041E Konvertierung nach {0} nicht möglich: {1}"
+	}
+	MSG_INVALID_CONVERSION = {
+				   "EN": "RSD0042E Invalid filesystem {0} for conversion. Use option -h to list possible arguments",
+				   "DE": "RSD0042E Ungültiges Dateisystem {0} für die Konvertierung. Option -h zeigt die möglichen Argumente"
+	}
+	MSG_ROOT_NOT_MOVED = {
+				   "EN": "RSD0043E Root partition {0} is still located on SD card. Replication requires a moved root partition",
+				   "DE": "RSD0043E Die Rootpartition {0} befindet sich noch auf der SD Karte. Replizierung benötigt eine umgezogene Rootpartition"
+	}
+	MSG_REPLICATING = {
+				   "EN": "RSD0044I Replicating {0} to {1} with a maximum staleness of {2} seconds. {3} directories are watched",
+				   "DE": "RSD0044I {0} wird auf {1} mit einer maximalen Verzögerung von {2} Sekunden repliziert. {3} Verzeichnisse werden überwacht"
+	}
+	MSG_REPLICATED = {
+				   "EN": "RSD0045I Replicated {0} changed paths to {1}. Oldest change was {2} seconds old",
+				   "DE": "RSD0045I {0} geänderte Pfade wurden auf {1} repliziert. Älteste Änderung war {2} Sekunden alt"
+	}
+	MSG_RESYNCHRONIZED = {
+				   "EN": "RSD0046I Resynchronized {0} to {1}",
+				   "DE": "RSD0046I {0} wurde mit {1} abgeglichen"
+	}
+	MSG_REPLICATION_EVENTS_LOST = {
+				   "EN": "RSD0047W Change notifications were lost. Next replication resynchronizes everything",
+				   "DE": "RSD0047W Änderungsbenachrichtigungen gingen verloren. Die nächste Replizierung gleicht alles ab"
+	}
+	MSG_REPLICATION_WATCHES_EXHAUSTED = {
+				   "EN": "RSD0048W Only {0} directories can be watched. Increase fs.inotify.max_user_watches. Everything is resynchronized periodically",
+				   "DE": "RSD0048W Es können nur {0} Verzeichnisse überwacht werden. Erhöhe fs.inotify.max_user_watches. Alles wird regelmäßig abgeglichen"
+	}
+	MSG_DEVICE_WILL_BE_ERASED = {
+				   "EN": "RSD0049W All data on {0} with size {1} will be erased",
+				   "DE": "RSD0049W Alle Daten auf {0} mit der Größe {1} werden gelöscht"
+	}
+	MSG_DEVICE_INVALID = {
+				   "EN": "RSD0050E Device {0} does not exist or is the SD card",
+				   "DE": "RSD0050E Gerät {0} existiert nicht oder ist die SD Karte"
+	}
+	MSG_DEVICE_IN_USE = {
+				   "EN": "RSD0051E Device {0} has mounted partitions {1}",
+				   "DE": "RSD0051E Gerät {0} hat gemountete Partitionen {1}"
+	}
+	MSG_PROVISIONING = {
+				   "EN": "RSD0052I Creating partition {0} aligned to {1} with filesystem {2}",
+				   "DE": "RSD0052I Partition {0} ausgerichtet auf {1} mit Dateisystem {2} wird erstellt"
+	}
+	MSG_SEED_MANIFEST = {
+				   "EN": "RSD0053I Creating manifest {0} of seed {1}",
+				   "DE": "RSD0053I Manifest {0} von Vorlage {1} wird erstellt"
+	}
+	MSG_SEEDING = {
+				   "EN": "RSD0054I Copying seed {0} to {1}",
+				   "DE": "RSD0054I Vorlage {0} wird auf {1} kopiert"
+	}
+	MSG_SEED_DELTA = {
+				   "EN": "RSD0055I Copied {0} of {1} entries with {2} which differ from the seed. Removed {3} entries not existing on {4}",
+				   "DE": "RSD0055I {0} von {1} Einträgen mit {2} die von der Vorlage abweichen wurden kopiert. {3} Einträge die auf {4} nicht existieren wurden gelöscht"
+	}
+	MSG_SEED_INVALID = {
+				   "EN": "RSD0056E Seed {0} does not exist",
+				   "DE": "RSD0056E Vorlage {0} existiert nicht"
+	}
+	MSG_EXCLUDED = {
+				   "EN": "RSD0057I {0} entries with {1} on {2} are excluded from the copy",
+				   "DE": "RSD0057I {0} Einträge mit {1} auf {2} werden nicht kopiert"
+	}
+	MSG_SWAPFILE_CREATED = {
+				   "EN": "RSD0058I Swap file {0} with {1} created on {2}",
+				   "DE": "RSD0058I Auslagerungsdatei {0} mit {1} wurde auf {2} erstellt"
+	}
+	MSG_RULES_INVALID = {
+				   "EN": "RSD0059E Exclusion rules {0} are neither a preset ({1}) nor a readable file",
+				   "DE": "RSD0059E Ausschlussregeln {0} sind weder eine Vorgabe ({1}) noch eine lesbare Datei"
+	}
+	MSG_IO_PROFILE = {
+				   "EN": "RSD0060I Device {0} of {1}: rotational {2}, transport {3}, queue depth {4}, discard {5}",
+				   "DE": "RSD0060I Gerät {0} von {1}: rotierend {2}, Transport {3}, Warteschlangentiefe {4}, Discard {5}"
+	}
+	MSG_IO_CHANGES = {
+				   "EN": "RSD0061I The following changes tune the I/O stack for {0}",
+				   "DE": "RSD0061I Die folgenden Änderungen optimieren den I/O Stack für {0}"
+	}
+	MSG_IO_TUNED = {
+				   "EN": "RSD0062I I/O stack tuned for {0}. The changes are active after the next boot",
+				   "DE": "RSD0062I I/O Stack für {0} wurde optimiert. Die Änderungen sind nach dem nächsten Boot aktiv"
+	}
+	MSG_IO_ALREADY_TUNED = {
+				   "EN": "RSD0063I I/O stack is already tuned for {0}",
+				   "DE": "RSD0063I I/O Stack ist bereits für {0} optimiert"
+	}
 	
 # baseclass for all the linux commands dealing with partitions
 
@@ -388,6 +547,30 @@ class df(BashCommand):
 			if lineElements[0] == partition:
 				return lineElements[1]
 			
+'''
+root@raspi4G:~# df -i
+Filesystem     Inodes  IUsed  IFree IUse% Mounted on
+/dev/root      232320  93622 138698   41% /
+devtmpfs        61037    371  60666    1% /dev
+/dev/mmcblk0p1      0      0      0     - /boot
+'''
+
+class dfi(BashCommand):
+
+	def __init__(self):
+		BashCommand.__init__(self, 'df -i')
+
+	def _postprocessResult(self):
+		self._commandResult = self._commandResult[1:]
+
+	def getUsed(self, partition):
+		if partition == ROOT_PARTITION:
+			partition = ROOTFS
+		for line in self.getResult():
+			lineElements = line.split()
+			if lineElements[0] == partition:
+				return int(lineElements[2])
+
 '''
 root@raspi4G:~# lsblk -rnb
 sda 8:0 1 4127195136 0 disk 
@@ -573,6 +756,8 @@ class blkid(BashCommand):
 		
 		return list(set(devices))
 
+PartitionInfo = collections.namedtuple("PartitionInfo", "partition size free mountpoint type partitiontableType")
+
 # Facade for all the various device/partition commands available on Linux
 	
 class DeviceManager():
@@ -619,8 +804,7 @@ class DeviceManager():
 	def getSDPartitions(self):
 		
 		if not os.path.exists(CMD_FILE):
-			print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_NO_CMDLINE_FOUND, CMD_FILE)
-			sys.exit(-1)
+			raise MigrationError(MessageCatalog.MSG_NO_CMDLINE_FOUND, CMD_FILE)
 			
 		result = executeCommand('cat ' + CMD_FILE)
 
@@ -643,9 +827,1593 @@ class DeviceManager():
 			mountpoint = self.getMountpoint(partition)
 			partitiontype = self.getType(partition)
 			partitionTabletype = self.getPartitiontableType(partition)
-			details.append([partition, size, free, mountpoint, partitiontype, partitionTabletype])
+			details.append(PartitionInfo(partition, size, free, mountpoint, partitiontype, partitionTabletype))
 		return details
 
+# converts the target partition into a flash optimized filesystem instead of the SD root filesystem type
+
+class FilesystemConverter(object):
+
+	# mkfs options, rootflags for cmdline.txt, mount options and fsck pass number for fstab
+	CONVERSIONS = {
+		"f2fs": { "mkfs": "mkfs.f2fs -f -O extra_attr,inode_checksum,sb_checksum", "rootflags": "lazytime", "options": "defaults,noatime,lazytime", "passno": "1" },
+		"btrfs": { "mkfs": "mkfs.btrfs -f", "rootflags": "compress=zstd", "options": "defaults,noatime,compress=zstd", "passno": "0" }
+	}
+
+	def __init__(self, filesystem):
+		self.filesystem = filesystem
+		self.__conversion = self.CONVERSIONS[filesystem]
+
+	@staticmethod
+	def getSupportedFilesystems():
+		return sorted(FilesystemConverter.CONVERSIONS.keys())
+
+	def getRootflags(self):
+		return self.__conversion["rootflags"]
+
+	def getMountOptions(self):
+		return self.__conversion["options"]
+
+	# the root filesystem has to be mounted by the kernel, so the filesystem either has to be built
+	# into the kernel or the module has to be part of the initramfs configured in config.txt
+	# returns None if the filesystem is supported, otherwise the reason why not
+
+	def checkSupport(self):
+		global logger
+
+		mkfs = self.__conversion["mkfs"].split()[0]
+		(rc, result) = executeCommand("which %s" % (mkfs), noRC=False)
+		if rc != 0:
+			return "%s not found" % (mkfs)
+
+		moduleDirectory = "/lib/modules/%s" % (os.uname()[2])
+		module = "/%s.ko" % (self.filesystem)
+		(rc, result) = executeCommand("grep -q '%s' %s/modules.builtin" % (module, moduleDirectory), noRC=False)
+		if rc == 0:
+			logger.debug("%s built into kernel" % (self.filesystem))
+			return None
+
+		(rc, result) = executeCommand("grep -q '%s' %s/modules.dep" % (module, moduleDirectory), noRC=False)
+		if rc != 0:
+			return "kernel module %s not available" % (module[1:])
+
+		configFile = os.path.join(os.path.dirname(CMD_FILE), "config.txt")
+		(rc, result) = executeCommand("grep -E '^[[:space:]]*initramfs[[:space:]]' %s" % (configFile), noRC=False)
+		if rc != 0:
+			return "kernel module %s requires an initramfs but no initramfs is configured in %s" % (module[1:], configFile)
+		initramfs = os.path.join(os.path.dirname(CMD_FILE), result.split()[1])
+		logger.debug("initramfs: %s" % (initramfs))
+
+		(rc, result) = executeCommand("lsinitramfs %s | grep -q '%s'" % (initramfs, module), noRC=False)
+		if rc != 0:
+			return "kernel module %s is missing in initramfs %s. Add %s to /etc/initramfs-tools/modules and update the initramfs" % (module[1:], initramfs, self.filesystem)
+		return None
+
+	def format(self, partition, mountpoint):
+		executeCommand("umount %s" % (partition))
+		executeCommand("%s %s" % (self.__conversion["mkfs"], partition))
+		executeCommand("mount -t %s -o %s %s %s" % (self.filesystem, self.__conversion["options"], partition, mountpoint))
+
+	def updateCmdline(self, cmdFile):
+		executeCommand("sed -i \"s|rootfstype=[^ ]\+|rootfstype=%s|g\" %s" % (self.filesystem, cmdFile))
+		(rc, result) = executeCommand("grep -q \"rootflags=\" %s" % (cmdFile), noRC=False)
+		if rc == 0:
+			executeCommand("sed -i \"s|rootflags=[^ ]\+|rootflags=%s|g\" %s" % (self.__conversion["rootflags"], cmdFile))
+		else:
+			executeCommand("sed -i \"1 s|$| rootflags=%s|\" %s" % (self.__conversion["rootflags"], cmdFile))
+
+	# update type, options and fsck pass of the root filesystem entry
+
+	def updateFstab(self, fstabFile):
+		lines = []
+		with open(fstabFile) as f:
+			for line in f:
+				fields = line.split()
+				if len(fields) >= 4 and not fields[0].startswith('#') and fields[1] == '/':
+					fields = fields[:2] + [self.filesystem, self.__conversion["options"], "0", self.__conversion["passno"]]
+					line = "  ".join(fields) + "\n"
+				lines.append(line)
+		with open(fstabFile, "w") as f:
+			f.writelines(lines)
+
+# creates an aligned GPT partition on an empty device and a filesystem tuned for the copy
+
+class Provisioner(object):
+
+	# erase block size of most USB flash media, used if the device doesn't report an optimal io size
+	ERASE_BLOCK_SIZE = 4 * 1024 * 1024
+	FS_BLOCK_SIZE = 4096
+	MOUNTPOINT = "/mnt/%s" % MYNAME
+
+	def __init__(self, device):
+		self.device = device
+		self.queue = BlockQueue(device)
+		self.partition = device + ("p1" if device[-1].isdigit() else "1")
+
+	# partitions of the device which are mounted
+
+	def getMountedPartitions(self):
+		name = os.path.basename(self.device)
+		blk = lsblk()
+		return [partition for partition in blk.getPartitions() if partition.startswith(name) and blk.getMountpoint('/dev/' + partition) is not None]
+
+	# alignment in bytes, least common multiple of the optimal io size and the erase block size.
+	# Some USB-SATA bridges report an optimal io size which isn't a power of 2 (e.g. 33553920),
+	# it's ignored because the lcm would be huge and such a size doesn't match the flash pages
+
+	def getAlignment(self):
+		optimal = self.queue.getOptimalIOSize()
+		if optimal <= 0 or optimal & (optimal - 1) != 0:
+			return self.ERASE_BLOCK_SIZE
+		return max(optimal, self.ERASE_BLOCK_SIZE)
+
+	# at least two inodes for each used inode of the source per average file size, rounded down to a power of 2
+
+	def getInodeRatio(self, sourcePartition):
+		dm = DeviceManager()
+		used = dm.getSize(sourcePartition) - dm.getFree(sourcePartition)
+		inodes = dfi().getUsed(sourcePartition)
+		if not inodes:
+			return 16384
+		ratio = max(used / inodes / 2, self.FS_BLOCK_SIZE)
+		return min(2 ** int(math.log(ratio, 2)), 65536)
+
+	def __mkfs(self, filesystem, sourcePartition):
+		alignment = self.getAlignment()
+		if filesystem in FilesystemConverter.getSupportedFilesystems():
+			# f2fs and btrfs are formatted the same way as the conversion does
+			return FilesystemConverter.CONVERSIONS[filesystem]["mkfs"] + " " + self.partition
+		if filesystem in ("ext2", "ext3", "ext4"):
+			stride = max(alignment / self.FS_BLOCK_SIZE, 1)
+			return "mkfs.%s -F -b %d -i %d -E stride=%d,stripe_width=%d,lazy_itable_init=0,lazy_journal_init=0 %s" % (
+				filesystem, self.FS_BLOCK_SIZE, self.getInodeRatio(sourcePartition), stride, stride, self.partition)
+		return "mkfs.%s %s" % (filesystem, self.partition)
+
+	def provision(self, filesystem, sourcePartition):
+		global logger
+
+		sectorSize = self.queue.getLogicalBlockSize()
+		alignment = self.getAlignment() / sectorSize
+		# /sys/block/<disk>/size is always in 512 byte units, the last 33 sectors hold the backup GPT
+		with open("/sys/block/%s/size" % (self.queue.disk)) as f:
+			sectors = int(f.read().strip()) * 512 / sectorSize
+		lastSector = (sectors - 34) / alignment * alignment - 1
+		logger.debug("alignment: %d sectors - sectors: %d - last sector: %d" % (alignment, sectors, lastSector))
+
+		executeCommand("sgdisk --zap-all %s" % (self.device))
+		executeCommand("sgdisk -a %d -n 1:%d:%d -t 1:8300 %s" % (alignment, alignment, lastSector, self.device))
+		executeCommand("partprobe %s; udevadm settle" % (self.device))
+
+		command = self.__mkfs(filesystem, sourcePartition)
+		logger.debug("mkfs: %s" % (command))
+		executeCommand(command)
+
+		if not os.path.exists(self.MOUNTPOINT):
+			os.makedirs(self.MOUNTPOINT)
+		# the copy has to be written with the options of the conversion, e.g. btrfs compression
+		if filesystem in FilesystemConverter.getSupportedFilesystems():
+			executeCommand("mount -t %s -o %s %s %s" % (filesystem, FilesystemConverter.CONVERSIONS[filesystem]["options"], self.partition, self.MOUNTPOINT))
+		else:
+			executeCommand("mount %s %s" % (self.partition, self.MOUNTPOINT))
+		return self.partition
+
+# gitignore style include/exclude rules for paths relative to root
+#
+# *, ? and [...] don't match /, ** matches any number of directories. Patterns with a leading or
+# inner / are anchored at root, others match at any depth. A trailing / matches directories only
+# and a leading ! includes paths excluded by a previous pattern (the last matching pattern wins).
+# Callers don't descend into excluded directories, so only the path itself is matched.
+# Without ! patterns all patterns are compiled into one regular expression.
+
+class ExclusionRules(object):
+
+	PRESETS = {
+		"raspios": [
+			"/tmp/*", "/var/tmp/*",
+			"/var/cache/apt/archives/*.deb", "/var/cache/apt/*.bin", "/var/lib/apt/lists/*", "!/var/lib/apt/lists/lock",
+			"/var/log/journal/*/*@*.journal", "/var/log/journal/*/*.journal~", "/var/log/*.gz", "/var/log/*.[0-9]",
+			"/home/*/.cache/", "/root/.cache/",
+			"__pycache__/"
+		]
+	}
+
+	def __init__(self, root="/", patterns=None):
+		self.root = root
+		self.patterns = []
+		self.__rules = []
+		self.__combined = None
+		for pattern in patterns or []:
+			self.add(pattern)
+
+	@staticmethod
+	def getPresets():
+		return sorted(ExclusionRules.PRESETS.keys())
+
+	@staticmethod
+	def readPatterns(filename):
+		with open(filename) as f:
+			return [line.rstrip("\n") for line in f]
+
+	def __len__(self):
+		return len(self.__rules)
+
+	@staticmethod
+	def __translate(pattern):
+		regex = []
+		i = 0
+		while i < len(pattern):
+			c = pattern[i]
+			if pattern.startswith("**/", i):
+				regex.append("(?:.*/)?")
+				i += 3
+			elif pattern.startswith("**", i):
+				regex.append(".*")
+				i += 2
+			elif c == "*":
+				regex.append("[^/]*")
+				i += 1
+			elif c == "?":
+				regex.append("[^/]")
+				i += 1
+			elif c == "[" and pattern.find("]", i + 1) > i + 1:
+				j = pattern.find("]", i + 1)
+				characters = pattern[i + 1:j].replace("\\", "\\\\")
+				if characters.startswith("!"):
+					characters = "^" + characters[1:]
+				regex.append("[" + characters + "]")
+				i = j + 1
+			elif c == "\\" and i + 1 < len(pattern):
+				regex.append(re.escape(pattern[i + 1]))
+				i += 2
+			else:
+				regex.append(re.escape(c))
+				i += 1
+		return "".join(regex)
+
+	def add(self, pattern):
+		pattern = pattern.rstrip()
+		if len(pattern) == 0 or pattern.startswith("#"):
+			return
+		self.patterns.append(pattern)
+		negated = pattern.startswith("!")
+		if negated:
+			pattern = pattern[1:]
+		directoryOnly = pattern.endswith("/")
+		pattern = pattern.rstrip("/")
+		regex = ExclusionRules.__translate(pattern.lstrip("/"))
+		if not "/" in pattern:
+			regex = "(?:.*/)?" + regex
+		self.__rules.append((regex + "$", negated, directoryOnly))
+		self.__combined = None
+
+	def __compile(self):
+		if any(negated for (regex, negated, directoryOnly) in self.__rules):
+			self.__combined = [(re.compile(regex), negated, directoryOnly) for (regex, negated, directoryOnly) in self.__rules]
+			return
+		combined = {}
+		for isDirectory in (False, True):
+			regexes = [regex for (regex, negated, directoryOnly) in self.__rules if isDirectory or not directoryOnly]
+			combined[isDirectory] = re.compile("|".join("(?:%s)" % (regex) for regex in regexes)) if len(regexes) > 0 else None
+		self.__combined = combined
+
+	def isExcluded(self, path, isDirectory=False):
+		if len(self.__rules) == 0:
+			return False
+		if self.__combined is None:
+			self.__compile()
+		relativePath = os.path.relpath(path, self.root) if os.path.isabs(path) else path
+		if isinstance(self.__combined, dict):
+			regex = self.__combined[isDirectory]
+			return regex is not None and regex.match(relativePath) is not None
+		for (regex, negated, directoryOnly) in reversed(self.__combined):
+			if (isDirectory or not directoryOnly) and regex.match(relativePath):
+				return not negated
+		return False
+
+	# rsync matches patterns with an inner / at any depth, gitignore anchors them at root
+
+	@staticmethod
+	def __rsyncPattern(pattern):
+		if not pattern.startswith("/") and not pattern.startswith("**/") and "/" in pattern.rstrip("/"):
+			return "/" + pattern
+		return pattern
+
+	# rsync filter rules, the first matching rsync rule wins
+
+	def getRsyncFilter(self):
+		return "\n".join(("+ " + ExclusionRules.__rsyncPattern(pattern[1:])) if pattern.startswith("!") else ("- " + ExclusionRules.__rsyncPattern(pattern)) for pattern in reversed(self.patterns)) + "\n"
+
+# entries excluded by the rules as (paths relative to sourceDirectory, bytes allocated by them)
+
+def collectExcluded(sourceDirectory, rules):
+	rootDevice = os.lstat(sourceDirectory).st_dev
+	excluded = []
+	for (path, st) in walkFilesystem(sourceDirectory, rootDevice, rules, excluded):
+		pass
+	excludedBytes = 0
+	for (path, st) in excluded:
+		if stat.S_ISDIR(st.st_mode) and st.st_dev == rootDevice:
+			excludedBytes += sum(entry[1].st_blocks * 512 for entry in walkFilesystem(path, rootDevice) if stat.S_ISREG(entry[1].st_mode))
+		elif stat.S_ISREG(st.st_mode):
+			excludedBytes += st.st_blocks * 512
+	return ([os.path.relpath(path, sourceDirectory) for (path, st) in excluded], excludedBytes)
+
+# swap files are excluded from the copy and created with the same size on the target partition
+# returns a list of (path relative to sourceDirectory, size)
+
+def detectSwapFiles(sourceDirectory):
+	swapFiles = set()
+	if os.path.exists("/proc/swaps"):
+		with open("/proc/swaps") as f:
+			for line in f.readlines()[1:]:
+				fields = line.split()
+				if len(fields) > 1 and fields[1] == "file":
+					swapFiles.add(fields[0])
+	# Raspberry Pi OS creates the swap file with dphys-swapfile
+	configFile = os.path.join(sourceDirectory, "etc/dphys-swapfile")
+	if os.path.exists(configFile):
+		swapFile = "/var/swap"
+		with open(configFile) as f:
+			for line in f:
+				m = re.match("\s*CONF_SWAPFILE=\"?([^\"\s]+)", line)
+				if m:
+					swapFile = m.group(1)
+		swapFiles.add(swapFile)
+
+	rootDevice = os.lstat(sourceDirectory).st_dev
+	result = []
+	for swapFile in sorted(swapFiles):
+		path = os.path.join(sourceDirectory, swapFile.lstrip("/"))
+		if os.path.isfile(path) and not os.path.islink(path) and os.lstat(path).st_dev == rootDevice:
+			result.append((os.path.relpath(path, sourceDirectory), os.lstat(path).st_size))
+	return result
+
+def createSwapFiles(targetDirectory, swapFiles, filesystem):
+	for (relativePath, size) in swapFiles:
+		path = os.path.join(targetDirectory, relativePath)
+		if os.path.lexists(path):
+			os.remove(path)
+		# btrfs swap files have to be nocow
+		if filesystem == "btrfs":
+			executeCommand("truncate -s 0 %s; chattr +C %s" % (pipes.quote(path), pipes.quote(path)))
+		(rc, result) = executeCommand("fallocate -l %d %s" % (size, pipes.quote(path)), noRC=False)
+		if rc != 0:
+			executeCommand("dd if=/dev/zero of=%s bs=1M count=%d" % (pipes.quote(path), (size + 1024 * 1024 - 1) / (1024 * 1024)))
+		os.chmod(path, 0600)
+		executeCommand("mkswap %s" % (pipes.quote(path)))
+
+# walk a directory tree without crossing filesystem boundaries (like tar --one-file-system)
+# and yield the path and lstat of each entry below top. Entries excluded by rules are skipped
+# and appended to excluded. A directory is yielded right before its entries and the entries of
+# a directory are sorted, so the paths are yielded sorted by their components (see pathKey)
+
+def walkFilesystem(top, rootDevice=None, rules=None, excluded=None):
+	if rootDevice is None:
+		rootDevice = os.lstat(top).st_dev
+	stack = [(top, iter(sorted(os.listdir(top))))]
+	while len(stack) > 0:
+		(directory, names) = stack[-1]
+		name = next(names, None)
+		if name is None:
+			stack.pop()
+			continue
+		path = os.path.join(directory, name)
+		try:
+			st = os.lstat(path)
+		except OSError:
+			continue
+		if rules is not None and rules.isExcluded(path, stat.S_ISDIR(st.st_mode)):
+			if excluded is not None:
+				excluded.append((path, st))
+			continue
+		yield (path, st)
+		if stat.S_ISDIR(st.st_mode) and st.st_dev == rootDevice:
+			try:
+				stack.append((path, iter(sorted(os.listdir(path)))))
+			except OSError:
+				pass
+
+def pathKey(relativePath):
+	return relativePath.split("/")
+
+# first link of all inodes with multiple links as (directory, name) of DirectoryTable, sorted by
+# inode number. Inodes with one link are not added. New entries are appended to a small unsorted
+# tail which is merged into the sorted entries when it's full. If the entries in memory exceed the
+# budget they are merged with the spilled entries into a new file which is searched through mmap
+
+class InodeTable(object):
+
+	DEFAULT_BUDGET = 8 * 1024 * 1024
+
+	# python 2 arrays have no 64 bit type on 32 bit systems, doubles hold inode numbers up to 2**53 exactly
+	INODE_TYPECODE = "L" if array.array("L").itemsize >= 8 else "d"
+	RECORD = struct.Struct("=Qqq")
+	TAIL_SIZE = 4096
+
+	def __init__(self, budget=DEFAULT_BUDGET, directory=None):
+		self.budget = budget
+		self.directory = directory
+		self.spills = 0
+		self.__inodes = array.array(self.INODE_TYPECODE)
+		self.__directories = array.array("l")
+		self.__names = array.array("l")
+		self.__tail = {}
+		self.__entrySize = self.__inodes.itemsize + self.__directories.itemsize + self.__names.itemsize
+		self.__spillFile = None
+		self.__spilled = None
+		self.__spilledCount = 0
+
+	def __len__(self):
+		return len(self.__inodes) + len(self.__tail) + self.__spilledCount
+
+	def add(self, inode, directory, name):
+		self.__tail[inode] = (directory, name)
+		if (len(self.__inodes) + len(self.__tail)) * self.__entrySize >= self.budget:
+			self.__spill()
+		elif len(self.__tail) >= self.TAIL_SIZE:
+			self.__mergeTail()
+
+	# the sorted arrays are copied in slices between the positions of the sorted tail entries
+
+	def __mergeTail(self):
+		tail = sorted((inode, directory, name) for (inode, (directory, name)) in self.__tail.iteritems())
+		positions = [bisect.bisect_left(self.__inodes, entry[0]) for entry in tail]
+		merged = []
+		for (field, entries) in enumerate((self.__inodes, self.__directories, self.__names)):
+			result = array.array(entries.typecode)
+			start = 0
+			for (position, entry) in zip(positions, tail):
+				result.extend(entries[start:position])
+				result.append(entry[field])
+				start = position
+			result.extend(entries[start:])
+			merged.append(result)
+		(self.__inodes, self.__directories, self.__names) = merged
+		self.__tail.clear()
+
+	# returns (directory, name) of the first link or None
+	def get(self, inode):
+		i = bisect.bisect_left(self.__inodes, inode)
+		if i < len(self.__inodes) and self.__inodes[i] == inode:
+			return (self.__directories[i], self.__names[i])
+		if inode in self.__tail:
+			return self.__tail[inode]
+		low = 0
+		high = self.__spilledCount
+		while low < high:
+			middle = (low + high) / 2
+			(spilledInode, directory, name) = self.RECORD.unpack_from(self.__spilled, middle * self.RECORD.size)
+			if spilledInode < inode:
+				low = middle + 1
+			elif spilledInode > inode:
+				high = middle
+			else:
+				return (directory, name)
+		return None
+
+	def __spilledRecords(self):
+		for i in xrange(self.__spilledCount):
+			yield self.RECORD.unpack_from(self.__spilled, i * self.RECORD.size)
+
+	def __spill(self):
+		global logger
+		self.__mergeTail()
+		spillFile = tempfile.TemporaryFile(prefix=MYNAME, dir=self.directory)
+		records = []
+		spilled = self.__spilledRecords()
+		nextSpilled = next(spilled, None)
+		for i in xrange(len(self.__inodes)):
+			while nextSpilled is not None and nextSpilled[0] < self.__inodes[i]:
+				records.append(self.RECORD.pack(*nextSpilled))
+				nextSpilled = next(spilled, None)
+			records.append(self.RECORD.pack(int(self.__inodes[i]), self.__directories[i], self.__names[i]))
+			if len(records) >= 4096:
+				spillFile.write("".join(records))
+				del records[:]
+		while nextSpilled is not None:
+			records.append(self.RECORD.pack(*nextSpilled))
+			nextSpilled = next(spilled, None)
+			if len(records) >= 4096:
+				spillFile.write("".join(records))
+				del records[:]
+		spillFile.write("".join(records))
+		spillFile.flush()
+
+		count = len(self)
+		self.close()
+		self.__spillFile = spillFile
+		self.__spilled = mmap.mmap(spillFile.fileno(), 0, access=mmap.ACCESS_READ)
+		self.__spilledCount = count
+		del self.__inodes[:]
+		del self.__directories[:]
+		del self.__names[:]
+		self.spills += 1
+		logger.debug("spilled %d inodes" % (count))
+
+	def close(self):
+		if self.__spilled is not None:
+			self.__spilled.close()
+			self.__spillFile.close()
+			self.__spilled = None
+			self.__spillFile = None
+			self.__spilledCount = 0
+
+# directories visited by an in-process copy. Their attributes are applied after all entries are
+# copied because creating entries changes the directory mtime. Directories are identified by
+# their index, path components by their offset in the component file. Recently used components
+# are interned, so repeated names are stored once. If the directories or components in memory
+# exceed the budget they are appended to files which are read through mmap
+
+class DirectoryTable(object):
+
+	ROOT = -1
+	RECORD = struct.Struct("=qqLLLdd")
+	INTERNED_COMPONENTS = 16384
+
+	def __init__(self, budget=InodeTable.DEFAULT_BUDGET, directory=None):
+		self.budget = budget
+		self.directory = directory
+		self.spills = 0
+		self.__parents = array.array("l")
+		self.__names = array.array("l")
+		self.__modes = array.array("L")
+		self.__uids = array.array("L")
+		self.__gids = array.array("L")
+		self.__atimes = array.array("d")
+		self.__mtimes = array.array("d")
+		self.__recordFile = None
+		self.__records = None
+		self.__spilledCount = 0
+		self.__componentIds = {}
+		self.__components = bytearray()
+		self.__componentFile = None
+		self.__spilledComponents = None
+		self.__spilledComponentSize = 0
+
+	def __len__(self):
+		return len(self.__parents) + self.__spilledCount
+
+	def intern(self, name):
+		componentId = self.__componentIds.get(name)
+		if componentId is None:
+			componentId = self.__spilledComponentSize + len(self.__components)
+			self.__components.extend(name + "\0")
+			if len(self.__componentIds) >= self.INTERNED_COMPONENTS:
+				self.__componentIds.clear()
+			self.__componentIds[name] = componentId
+			if len(self.__components) >= self.budget:
+				(self.__componentFile, self.__spilledComponents) = self.__spill(self.__componentFile, str(self.__components), self.__spilledComponents)
+				self.__spilledComponentSize += len(self.__components)
+				self.__components = bytearray()
+		return componentId
+
+	def getName(self, componentId):
+		if componentId >= self.__spilledComponentSize:
+			offset = componentId - self.__spilledComponentSize
+			return str(self.__components[offset:self.__components.index("\0", offset)])
+		return self.__spilledComponents[componentId:self.__spilledComponents.find("\0", componentId)]
+
+	def __spill(self, spillFile, data, spilled):
+		if spillFile is None:
+			spillFile = tempfile.TemporaryFile(prefix=MYNAME, dir=self.directory)
+		spillFile.seek(0, 2)
+		spillFile.write(data)
+		spillFile.flush()
+		if spilled is not None:
+			spilled.close()
+		self.spills += 1
+		return (spillFile, mmap.mmap(spillFile.fileno(), 0, access=mmap.ACCESS_READ))
+
+	def add(self, parent, name, st):
+		self.__parents.append(parent)
+		self.__names.append(self.intern(name))
+		self.__modes.append(stat.S_IMODE(st.st_mode))
+		self.__uids.append(st.st_uid)
+		self.__gids.append(st.st_gid)
+		self.__atimes.append(st.st_atime)
+		self.__mtimes.append(st.st_mtime)
+		if len(self.__parents) * self.RECORD.size >= self.budget:
+			records = "".join(self.RECORD.pack(self.__parents[i], self.__names[i], self.__modes[i], self.__uids[i], self.__gids[i], self.__atimes[i], self.__mtimes[i]) for i in xrange(len(self.__parents)))
+			(self.__recordFile, self.__records) = self.__spill(self.__recordFile, records, self.__records)
+			self.__spilledCount += len(self.__parents)
+			for attributes in (self.__parents, self.__names, self.__modes, self.__uids, self.__gids, self.__atimes, self.__mtimes):
+				del attributes[:]
+		return len(self) - 1
+
+	# returns (parent, name, mode, uid, gid, atime, mtime)
+	def __get(self, directory):
+		if directory < self.__spilledCount:
+			return self.RECORD.unpack_from(self.__records, directory * self.RECORD.size)
+		i = directory - self.__spilledCount
+		return (self.__parents[i], self.__names[i], self.__modes[i], self.__uids[i], self.__gids[i], self.__atimes[i], self.__mtimes[i])
+
+	def getPath(self, directory):
+		names = []
+		while directory != self.ROOT:
+			record = self.__get(directory)
+			names.append(self.getName(record[1]))
+			directory = record[0]
+		return os.path.join(*reversed(names)) if len(names) > 0 else ""
+
+	def apply(self, targetDirectory):
+		for directory in xrange(len(self) - 1, -1, -1):
+			(parent, name, mode, uid, gid, atime, mtime) = self.__get(directory)
+			path = os.path.join(targetDirectory, self.getPath(directory))
+			os.lchown(path, uid, gid)
+			os.chmod(path, mode)
+			os.utime(path, (atime, mtime))
+
+	def close(self):
+		for spilled in (self.__records, self.__recordFile, self.__spilledComponents, self.__componentFile):
+			if spilled is not None:
+				spilled.close()
+		(self.__records, self.__recordFile, self.__spilledComponents, self.__componentFile) = (None, None, None, None)
+
+# copy a file, symlink or special file with owner, mode and mtime
+
+def copyEntry(sourcePath, targetPath, st, bufferSize=1024 * 1024):
+	if os.path.lexists(targetPath):
+		os.remove(targetPath)
+	if stat.S_ISREG(st.st_mode):
+		with open(sourcePath, "rb") as source:
+			with open(targetPath, "wb") as target:
+				shutil.copyfileobj(source, target, bufferSize)
+	elif stat.S_ISLNK(st.st_mode):
+		os.symlink(os.readlink(sourcePath), targetPath)
+	else:
+		os.mknod(targetPath, st.st_mode, st.st_rdev)
+	os.lchown(targetPath, st.st_uid, st.st_gid)
+	# python 2 can't set the mode and mtime of symlinks
+	if not stat.S_ISLNK(st.st_mode):
+		os.chmod(targetPath, stat.S_IMODE(st.st_mode))
+		os.utime(targetPath, (st.st_atime, st.st_mtime))
+
+# queue characteristics of the block device a partition is located on
+
+class BlockQueue(object):
+
+	def __init__(self, partition):
+		self.partition = partition
+		self.disk = BlockQueue.getDisk(partition)
+		self.__attributes = {}
+
+	# /sys/class/block/sda1 -> .../block/sda/sda1, partitions have a 'partition' attribute
+	@staticmethod
+	def getDisk(partition):
+		name = os.path.basename(partition)
+		sysPath = os.path.realpath("/sys/class/block/" + name)
+		if os.path.exists(os.path.join(sysPath, "partition")):
+			return os.path.basename(os.path.dirname(sysPath))
+		return name
+
+	def __read(self, attribute, default):
+		if attribute not in self.__attributes:
+			try:
+				with open("/sys/block/%s/queue/%s" % (self.disk, attribute)) as f:
+					self.__attributes[attribute] = int(f.read().strip())
+			except (IOError, ValueError):
+				self.__attributes[attribute] = default
+		return self.__attributes[attribute]
+
+	def isRotational(self):
+		return self.__read("rotational", 1) == 1
+
+	def getOptimalIOSize(self):
+		return self.__read("optimal_io_size", 0)
+
+	def getMaxSectorsKB(self):
+		return self.__read("max_sectors_kb", 120)
+
+	def getNrRequests(self):
+		return self.__read("nr_requests", 128)
+
+	def getLogicalBlockSize(self):
+		return self.__read("logical_block_size", 512)
+
+	def getDiscardMaxBytes(self):
+		return self.__read("discard_max_bytes", 0)
+
+	# the scheduler file lists all available schedulers, the active one in brackets
+	def getSchedulers(self):
+		try:
+			with open("/sys/block/%s/queue/scheduler" % (self.disk)) as f:
+				return f.read().replace("[", "").replace("]", "").split()
+		except IOError:
+			return []
+
+	# field 7 of /sys/block/<disk>/stat is the number of 512 byte sectors written
+	def getBytesWritten(self):
+		try:
+			with open("/sys/block/%s/stat" % (self.disk)) as f:
+				return int(f.read().split()[6]) * 512
+		except (IOError, ValueError, IndexError):
+			return None
+
+# characteristics of a device and the I/O settings derived from them by IOTuner. A FileChange
+# with a symlink creates the symlink instead of writing the file
+
+IOProfile = collections.namedtuple("IOProfile", "disk rotational transport queueDepth discard")
+IOSettings = collections.namedtuple("IOSettings", "scheduler readAheadKB mountOptions discard rootdelay")
+FileChange = collections.namedtuple("FileChange", "path before after symlink")
+
+# tunes the I/O stack of the migrated system to the device of the new root partition
+#
+# 1) The device is inspected: rotational, queue depth, discard support and USB transport (uas or usb-storage)
+# 2) An udev rule sets the I/O scheduler and read-ahead of the device
+# 3) The root filesystem is mounted with noatime and a longer commit interval on flash devices.
+#    Discard is done continuously on btrfs and periodically by fstrim.timer on other filesystems
+# 4) cmdline.txt gets matching rootflags, rootwait and rootdelay for disks which need to spin up.
+#    elevator= is removed, it's ignored by kernels with blk-mq
+
+class IOTuner(object):
+
+	UDEV_RULE = "etc/udev/rules.d/60-%s.rules" % (MYNAME)
+	FSTRIM_TIMER = "/lib/systemd/system/fstrim.timer"
+	FSTRIM_TIMER_LINK = "etc/systemd/system/timers.target.wants/fstrim.timer"
+	# seconds rotational disks need to spin up after they are detected
+	ROOTDELAY = 5
+	# filesystems which support commit=
+	COMMIT_FILESYSTEMS = [ "ext4", "btrfs" ]
+	ATIME_OPTIONS = [ "atime", "noatime", "relatime", "norelatime", "strictatime" ]
+	TRANSPORTS = [ "uas", "usb-storage" ]
+
+	def __init__(self, partition, filesystem):
+		self.partition = partition
+		self.filesystem = filesystem
+		self.queue = BlockQueue(partition)
+		self.disk = self.queue.disk
+
+	# the USB interface the disk is attached to is bound either to the uas or usb-storage driver
+	def getTransport(self):
+		path = os.path.realpath("/sys/block/%s/device" % (self.disk))
+		while path.startswith("/sys/devices/"):
+			driver = os.path.join(path, "driver")
+			if os.path.islink(driver) and os.path.basename(os.path.realpath(driver)) in self.TRANSPORTS:
+				return os.path.basename(os.path.realpath(driver))
+			path = os.path.dirname(path)
+		return None
+
+	# queue depth of the SCSI device, usb-storage has one outstanding command only
+	def getQueueDepth(self):
+		try:
+			with open("/sys/block/%s/device/queue_depth" % (self.disk)) as f:
+				return int(f.read().strip())
+		except (IOError, ValueError):
+			return 1
+
+	def getSerial(self):
+		(rc, result) = executeCommand("udevadm info --query=property --name=/dev/%s" % (self.disk), noRC=False)
+		m = re.search("^ID_SERIAL=(.+)$", result, re.MULTILINE) if rc == 0 else None
+		return m.group(1) if m else None
+
+	def inspect(self):
+		return IOProfile(self.disk, self.queue.isRotational(), self.getTransport(), self.getQueueDepth(), self.queue.getDiscardMaxBytes() > 0)
+
+	def getSettings(self, profile):
+		available = self.queue.getSchedulers()
+		if profile.rotational:
+			preferred = [ "bfq", "mq-deadline", "deadline" ]
+		elif profile.queueDepth > 1:
+			preferred = [ "none", "noop", "mq-deadline" ]
+		else:
+			# the device can't reorder requests, the scheduler merges them and prefers reads
+			preferred = [ "mq-deadline", "deadline", "none", "noop" ]
+		scheduler = next((s for s in preferred if s in available), None)
+		readAheadKB = 1024 if profile.rotational else 256
+
+		options = [ "noatime" ]
+		if self.filesystem in self.COMMIT_FILESYSTEMS and not profile.rotational:
+			# SSDs with a command queue write faster than USB sticks which get the longer interval
+			options.append("commit=%d" % (30 if profile.discard and profile.queueDepth > 1 else 60))
+		discard = None
+		if profile.discard:
+			discard = "continuous" if self.filesystem == "btrfs" else "periodic"
+		if discard == "continuous":
+			options.append("discard=async")
+		rootdelay = self.ROOTDELAY if profile.rotational else None
+		return IOSettings(scheduler, readAheadKB, options, discard, rootdelay)
+
+	# options which are not set by the settings are kept
+
+	def __tuneOptions(self, options, newOptions):
+		kept = [o for o in options if o not in self.ATIME_OPTIONS and not o.startswith("commit=") and o.split("=")[0] not in ("discard", "nodiscard")]
+		return kept + newOptions
+
+	def tuneFstab(self, fstab, settings):
+		lines = []
+		for line in fstab.splitlines(True):
+			fields = line.split()
+			if len(fields) >= 4 and not fields[0].startswith('#') and fields[1] == '/':
+				fields[3] = ",".join(self.__tuneOptions(fields[3].split(","), settings.mountOptions))
+				line = "  ".join(fields) + "\n"
+			lines.append(line)
+		return "".join(lines)
+
+	# rootflags are passed to the filesystem, noatime is set by the remount of systemd with the fstab options
+
+	def tuneCmdline(self, cmdline, settings):
+		rootflags = []
+		parameters = []
+		for parameter in cmdline.split():
+			if parameter.startswith("rootflags="):
+				rootflags = parameter[len("rootflags="):].split(",")
+			elif not parameter.startswith("elevator=") and not parameter.startswith("rootdelay=") and parameter != "rootwait":
+				parameters.append(parameter)
+		rootflags = self.__tuneOptions(rootflags, [o for o in settings.mountOptions if o not in self.ATIME_OPTIONS])
+		if len(rootflags) > 0:
+			parameters.append("rootflags=" + ",".join(rootflags))
+		parameters.append("rootwait")
+		if settings.rootdelay is not None:
+			parameters.append("rootdelay=%d" % (settings.rootdelay))
+		return " ".join(parameters) + "\n"
+
+	def getUdevRule(self, settings):
+		serial = self.getSerial()
+		match = 'ENV{ID_SERIAL}=="%s"' % (serial) if serial is not None else 'KERNEL=="%s"' % (self.disk)
+		attributes = 'ATTR{queue/read_ahead_kb}="%d"' % (settings.readAheadKB)
+		if settings.scheduler is not None:
+			attributes = 'ATTR{queue/scheduler}="%s", %s' % (settings.scheduler, attributes)
+		return "# I/O scheduler and read-ahead of the root partition device %s, created by %s\n" % (self.partition, MYNAME) + \
+			'ACTION=="add|change", SUBSYSTEM=="block", ENV{DEVTYPE}=="disk", %s, %s\n' % (match, attributes)
+
+	@staticmethod
+	def __readFile(path):
+		if not os.path.exists(path):
+			return ""
+		with open(path) as f:
+			return f.read()
+
+	# returns the FileChanges for the root directory of the migrated system and its cmdline.txt
+
+	def plan(self, settings, rootDirectory, cmdFile):
+		changes = []
+		fstabFile = os.path.join(rootDirectory, "etc/fstab")
+		fstab = IOTuner.__readFile(fstabFile)
+		changes.append(FileChange(fstabFile, fstab, self.tuneFstab(fstab, settings), None))
+		cmdline = IOTuner.__readFile(cmdFile)
+		changes.append(FileChange(cmdFile, cmdline, self.tuneCmdline(cmdline, settings), None))
+		ruleFile = os.path.join(rootDirectory, self.UDEV_RULE)
+		changes.append(FileChange(ruleFile, IOTuner.__readFile(ruleFile), self.getUdevRule(settings), None))
+		timerLink = os.path.join(rootDirectory, self.FSTRIM_TIMER_LINK)
+		if settings.discard == "periodic" and os.path.exists(os.path.join(rootDirectory, self.FSTRIM_TIMER.lstrip("/"))) and not os.path.lexists(timerLink):
+			changes.append(FileChange(timerLink, "", "", self.FSTRIM_TIMER))
+		return [change for change in changes if change.before != change.after or change.symlink is not None]
+
+	@staticmethod
+	def getDiff(changes):
+		diff = []
+		for change in changes:
+			if change.symlink is not None:
+				diff.append("--- /dev/null\n+++ %s\n+-> %s\n" % (change.path, change.symlink))
+			else:
+				diff.extend(difflib.unified_diff(change.before.splitlines(True), change.after.splitlines(True),
+					change.path if len(change.before) > 0 else "/dev/null", change.path))
+		return "".join(diff)
+
+	@staticmethod
+	def apply(changes):
+		for change in changes:
+			if not os.path.exists(os.path.dirname(change.path)):
+				os.makedirs(os.path.dirname(change.path))
+			if change.symlink is not None:
+				os.symlink(change.symlink, change.path)
+			else:
+				with open(change.path, "w") as f:
+					f.write(change.after)
+
+# tunes and executes the root partition copy according to source and target device characteristics
+#
+# 1) A short calibration with direct IO selects the buffer size
+# 2) The number of concurrent tar pipes is derived from rotational and nr_requests of the target
+# 3) The source tree is split into work units. Directories with small files are batched into one
+#    tar pipe, directories with large files are streamed in their own tar pipe
+# 4) During the copy the number of concurrent tar pipes is adjusted (hill climbing) on the
+#    throughput observed on the target device
+
+class CopyTuner(object):
+
+	BUFFER_SIZES = [64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+	CALIBRATION_BYTES = 16 * 1024 * 1024
+	CALIBRATION_FILE = ".%s.calibration" % MYNAME
+	SMALL_FILE_SIZE = 64 * 1024
+	BATCH_SIZE = 64 * 1024 * 1024
+	MAX_WORKERS = 8
+	SAMPLE_INTERVAL = 5
+	PROGRESS_INTERVAL = 30
+
+	def __init__(self, sourcePartition, targetPartition, report=None, rules=None):
+		self.report = report
+		self.rules = rules
+		self.excluded = []
+		self.linked = []
+		self.linkedBytes = 0
+		self.sourcePartition = sourcePartition
+		self.targetPartition = targetPartition
+		self.source = BlockQueue(sourcePartition)
+		self.target = BlockQueue(targetPartition)
+		self.bufferSize = self.BUFFER_SIZES[0]
+		self.workers = 1
+		self.maxWorkers = 1
+		self.__direction = 1
+		self.__lastRate = None
+
+	def __measure(self, command, size):
+		start = time.time()
+		executeCommand(command)
+		return size / max(time.time() - start, 0.001)
+
+	def calibrate(self, targetDirectory):
+		global logger
+
+		limit = max(min(self.source.getMaxSectorsKB(), self.target.getMaxSectorsKB()) * 1024, self.BUFFER_SIZES[0])
+		candidates = [size for size in self.BUFFER_SIZES if size <= limit]
+		optimal = self.target.getOptimalIOSize()
+		if optimal > 0 and optimal <= self.BUFFER_SIZES[-1] and optimal not in candidates:
+			candidates.append(optimal)
+
+		probe = os.path.join(targetDirectory, self.CALIBRATION_FILE)
+		bestRate = 0
+		try:
+			for size in sorted(candidates):
+				count = max(1, self.CALIBRATION_BYTES / size)
+				readRate = self.__measure("dd if=%s of=/dev/null bs=%d count=%d iflag=direct 2>/dev/null" % (self.sourcePartition, size, count), size * count)
+				writeRate = self.__measure("dd if=/dev/zero of=%s bs=%d count=%d oflag=direct conv=fsync 2>/dev/null" % (pipes.quote(probe), size, count), size * count)
+				rate = min(readRate, writeRate)
+				logger.debug("calibration bs %s: read %s/s - write %s/s" % (size, asReadable(readRate), asReadable(writeRate)))
+				# larger buffers have to be significantly faster to be used
+				if rate > bestRate * 1.05:
+					bestRate = rate
+					self.bufferSize = size
+		finally:
+			if os.path.exists(probe):
+				os.remove(probe)
+
+		cpus = multiprocessing.cpu_count()
+		if self.target.isRotational():
+			# seeks kill throughput on spinning disks, allow just one additional pipe to be probed
+			self.workers = 1
+			self.maxWorkers = 2
+		else:
+			self.workers = max(1, min(cpus, self.target.getNrRequests() / 64, 4))
+			self.maxWorkers = max(2, min(cpus * 2, self.target.getNrRequests() / 16, self.MAX_WORKERS))
+		logger.debug("bufferSize: %s - workers: %s - maxWorkers: %s" % (self.bufferSize, self.workers, self.maxWorkers))
+		logEvent("copy_tuning", bufferSize=self.bufferSize, workers=self.workers, maxWorkers=self.maxWorkers, sourceRotational=self.source.isRotational(), targetRotational=self.target.isRotational())
+
+		return (self.bufferSize, self.workers, self.maxWorkers)
+
+	# summarize a directory tree as [bytes, entries], excluded entries are appended to excluded and
+	# entries with multiple links to linked
+
+	def __summarize(self, path, rootDevice, excluded, linked):
+		summary = [0, 1]
+		for (entry, st) in walkFilesystem(path, rootDevice, self.rules, excluded):
+			summary[1] += 1
+			if not stat.S_ISDIR(st.st_mode) and st.st_nlink > 1:
+				linked.append((entry, st))
+			elif stat.S_ISREG(st.st_mode):
+				summary[0] += st.st_size
+		return summary
+
+	# split the source tree into work units [paths, bytes, entries, recursive] and a skeleton of
+	# directories which have to be created first and whose attributes have to be restored last.
+	# Excluded entries below the work units are collected in excluded. Entries with multiple links
+	# are collected in linked and copied by one tar pipe after the work units to keep the hardlinks
+
+	def planUnits(self, sourceDirectory):
+		rootDevice = os.lstat(sourceDirectory).st_dev
+		candidates = []
+		skeleton = []
+		excluded = []
+		linked = []
+
+		for name in sorted(os.listdir(sourceDirectory)):
+			path = os.path.join(sourceDirectory, name)
+			st = os.lstat(path)
+			if self.rules is not None and self.rules.isExcluded(path, stat.S_ISDIR(st.st_mode)):
+				continue
+			if not stat.S_ISDIR(st.st_mode) and st.st_nlink > 1:
+				linked.append((path, st))
+			elif not stat.S_ISDIR(st.st_mode):
+				candidates.append([name, st.st_size if stat.S_ISREG(st.st_mode) else 0, 1])
+			elif st.st_dev != rootDevice:
+				skeleton.append(name)
+			else:
+				children = []
+				for child in sorted(os.listdir(path)):
+					childPath = os.path.join(path, child)
+					childStat = os.lstat(childPath)
+					if self.rules is not None and self.rules.isExcluded(childPath, stat.S_ISDIR(childStat.st_mode)):
+						continue
+					if stat.S_ISDIR(childStat.st_mode) and childStat.st_dev != rootDevice:
+						skeleton.append(os.path.join(name, child))
+					elif stat.S_ISDIR(childStat.st_mode):
+						children.append([os.path.join(name, child)] + self.__summarize(childPath, rootDevice, excluded, linked))
+					elif childStat.st_nlink > 1:
+						linked.append((childPath, childStat))
+					else:
+						children.append([os.path.join(name, child), childStat.st_size if stat.S_ISREG(childStat.st_mode) else 0, 1])
+				skeleton.append(name)
+				candidates.extend(children)
+
+		units = []
+		batch = [[], 0, 0, True]
+		for (path, size, entries) in candidates:
+			if size / max(entries, 1) >= self.SMALL_FILE_SIZE:
+				units.append([[path], size, entries, True])
+			else:
+				batch[0].append(path)
+				batch[1] += size
+				batch[2] += entries
+				if batch[1] >= self.BATCH_SIZE:
+					units.append(batch)
+					batch = [[], 0, 0, True]
+		if len(batch[0]) > 0:
+			units.append(batch)
+
+		self.excluded = [os.path.relpath(excludedPath, sourceDirectory) for (excludedPath, excludedStat) in excluded]
+		self.linked = [os.path.relpath(linkedPath, sourceDirectory) for (linkedPath, linkedStat) in linked]
+		self.linkedBytes = sum(dict((linkedStat.st_ino, linkedStat.st_size) for (linkedPath, linkedStat) in linked if stat.S_ISREG(linkedStat.st_mode)).values())
+
+		# largest units first to balance the concurrent pipes
+		units.sort(key=lambda unit: unit[1], reverse=True)
+		return (units, sorted(skeleton))
+
+	def __command(self, sourceDirectory, targetDirectory, paths, recursive, excludeFile=None):
+		blockingFactor = self.bufferSize / 512
+		return "tar -C %s -cf - -b %d --one-file-system %s %s -- %s | tar -C %s -xpBf - -b %d" % (
+			pipes.quote(sourceDirectory), blockingFactor, "" if recursive else "--no-recursion",
+			"" if excludeFile is None else "--anchored --no-wildcards --exclude-from=%s" % (excludeFile),
+			" ".join(pipes.quote(p) for p in paths), pipes.quote(targetDirectory), blockingFactor)
+
+	def __adjust(self, rate):
+		global logger
+		if self.__lastRate is not None and rate < self.__lastRate * 0.95:
+			self.__direction = -self.__direction
+		self.workers = max(1, min(self.maxWorkers, self.workers + self.__direction))
+		self.__lastRate = rate
+		logger.debug("throughput %s/s - workers: %s" % (asReadable(rate), self.workers))
+
+	def copy(self, sourceDirectory, targetDirectory):
+
+		(pending, skeleton) = self.planUnits(sourceDirectory)
+		totalBytes = sum(unit[1] for unit in pending) + self.linkedBytes
+
+		# entries with multiple links are excluded from the work units
+		excludeFile = None
+		if len(self.excluded) + len(self.linked) > 0:
+			excludeFile = tempfile.NamedTemporaryFile(prefix=MYNAME)
+			excludeFile.write("".join("%s\n" % (path) for path in self.excluded + self.linked))
+			excludeFile.flush()
+
+		if len(skeleton) > 0:
+			executeCommand(self.__command(sourceDirectory, targetDirectory, skeleton, False))
+
+		running = []
+		copiedBytes = 0
+		startBytes = self.target.getBytesWritten()
+		(lastSample, lastBytes) = (time.time(), startBytes)
+		lastProgress = lastSample
+
+		try:
+			while len(pending) > 0 or len(running) > 0:
+				while len(pending) > 0 and len(running) < self.workers:
+					unit = pending.pop(0)
+					errors = tempfile.TemporaryFile()
+					proc = subprocess.Popen(self.__command(sourceDirectory, targetDirectory, unit[0], unit[3], excludeFile.name if excludeFile is not None else None), stdout=subprocess.PIPE, stderr=errors, shell=True)
+					running.append((proc, unit, errors))
+
+				time.sleep(0.5)
+
+				for (proc, unit, errors) in list(running):
+					if proc.poll() is None:
+						continue
+					running.remove((proc, unit, errors))
+					if proc.returncode != 0:
+						errors.seek(0)
+						raise Exception("Copy of %s failed with rc %d\nError message:\n%s" % (' '.join(unit[0]), proc.returncode, errors.read().rstrip()))
+					errors.close()
+					copiedBytes += unit[1]
+
+				now = time.time()
+				if now - lastSample >= self.SAMPLE_INTERVAL:
+					written = self.target.getBytesWritten()
+					if written is not None:
+						rate = (written - lastBytes) / (now - lastSample)
+						logEvent("copy_progress", copiedBytes=copiedBytes, totalBytes=totalBytes, bytesPerSecond=int(rate), workers=len(running))
+						if len(pending) > 0:
+							self.__adjust(rate)
+					(lastSample, lastBytes) = (now, written)
+
+				if now - lastProgress >= self.PROGRESS_INTERVAL and self.report is not None:
+					self.report(MessageCatalog.MSG_COPY_PROGRESS, asReadable(copiedBytes), asReadable(totalBytes), len(running))
+					lastProgress = now
+
+		finally:
+			for (proc, unit, errors) in running:
+				if proc.poll() is None:
+					proc.kill()
+				errors.close()
+			if excludeFile is not None:
+				excludeFile.close()
+
+		# all links of an inode have to be in the same archive to be restored as hardlinks. The
+		# directories of the links follow the links to restore the mtimes changed by the links
+		if len(self.linked) > 0:
+			blockingFactor = self.bufferSize / 512
+			directories = sorted(set(os.path.dirname(path) for path in self.linked) - set([""]))
+			with tempfile.NamedTemporaryFile(prefix=MYNAME) as listFile:
+				listFile.write("\0".join(self.linked + directories) + "\0")
+				listFile.flush()
+				executeCommand("tar -C %s -cf - -b %d --no-recursion --null -T %s | tar -C %s -xpBf - -b %d" % (
+					pipes.quote(sourceDirectory), blockingFactor, listFile.name, pipes.quote(targetDirectory), blockingFactor))
+
+		# restore attributes of directories which were modified by the work units
+		if len(skeleton) > 0:
+			executeCommand(self.__command(sourceDirectory, targetDirectory, skeleton, False))
+
+		return totalBytes
+
+# seeds the target partition with a golden image or reference tree and copies only the files
+# of the SD root partition which differ from the seed
+#
+# The manifest IMAGE_OR_DIR.manifest describes every entry of the seed by type, size, mtime, mode,
+# owner and link target. It decides without reading the SD card which files have to be copied
+# (like the rsync quick check). The manifest of an image is created on first use. Files in a tree
+# may change without changing the root of the tree, so the manifest of a tree is created from
+# the copy of the tree on the target partition. Content hashes are not used because
+# hashing a file on the SD card requires reading it, which is what the seed should avoid.
+
+class Seeder(object):
+
+	MOUNTPOINT = "/run/%s.seed" % MYNAME
+	MANIFEST_FIELDS = 8
+	MANIFEST_VERSION = "2"
+	# root partition of Raspberry Pi OS images
+	IMAGE_ROOT_PARTITION = 2
+
+	def __init__(self, seed):
+		self.seed = seed.rstrip('/')
+		self.manifestFile = self.seed + ".manifest"
+		self.seedDirectory = None
+		self.__loopDevice = None
+
+	def attach(self):
+		if os.path.isdir(self.seed):
+			self.seedDirectory = self.seed
+			return
+		self.__loopDevice = executeCommand("losetup -P -f --show %s" % (pipes.quote(self.seed))).strip()
+		if not os.path.exists(self.MOUNTPOINT):
+			os.makedirs(self.MOUNTPOINT)
+		executeCommand("mount -o ro %sp%d %s" % (self.__loopDevice, self.IMAGE_ROOT_PARTITION, self.MOUNTPOINT))
+		self.seedDirectory = self.MOUNTPOINT
+
+	def detach(self):
+		if self.__loopDevice is not None:
+			executeCommand("umount %s; losetup -d %s" % (self.MOUNTPOINT, self.__loopDevice))
+			self.__loopDevice = None
+
+	@staticmethod
+	def describe(path, st):
+		if stat.S_ISREG(st.st_mode):
+			(kind, size, link) = ("f", st.st_size, "")
+		elif stat.S_ISDIR(st.st_mode):
+			(kind, size, link) = ("d", 0, "")
+		elif stat.S_ISLNK(st.st_mode):
+			(kind, size, link) = ("l", 0, os.readlink(path))
+		else:
+			(kind, size, link) = ("o", st.st_rdev, "")
+		return (kind, str(size), str(int(st.st_mtime)), str(stat.S_IMODE(st.st_mode)), str(st.st_uid), str(st.st_gid), link)
+
+	@staticmethod
+	def remove(path):
+		if os.path.isdir(path) and not os.path.islink(path):
+			shutil.rmtree(path, ignore_errors=True)
+		elif os.path.lexists(path):
+			os.remove(path)
+
+	# size and mtime of an image, inode, mtime and ctime of the root of a tree
+
+	def isTree(self):
+		return os.path.isdir(self.seed)
+
+	def getIdentity(self):
+		if self.isTree():
+			return "tree"
+		st = os.stat(self.seed)
+		return "image:%d:%d" % (st.st_size, int(st.st_mtime))
+
+	# the manifest has to be rebuilt if its format changed or the image was replaced
+
+	def isManifestCurrent(self):
+		if self.isTree() or not os.path.exists(self.manifestFile):
+			return False
+		with open(self.manifestFile, "rb") as f:
+			header = f.read(4096).split("\0")[:3]
+		return header == [MYNAME, self.MANIFEST_VERSION, self.getIdentity()]
+
+	# manifest fields are \0 terminated because file names may contain any other character.
+	# The header holds the manifest format version and the identity of the seed. The entries
+	# are in the order of walkFilesystem, i.e. sorted by pathKey
+
+	def buildManifest(self, directory=None):
+		directory = directory or self.seedDirectory
+		with open(self.manifestFile + ".new", "wb") as f:
+			f.write("\0".join((MYNAME, self.MANIFEST_VERSION, self.getIdentity())) + "\0")
+			for (path, st) in walkFilesystem(directory):
+				fields = (os.path.relpath(path, directory),) + Seeder.describe(path, st)
+				f.write("\0".join(fields) + "\0")
+		os.rename(self.manifestFile + ".new", self.manifestFile)
+
+	# yields (path, description) of the manifest entries without reading the whole manifest
+
+	def readManifest(self, bufferSize=1024 * 1024):
+		with open(self.manifestFile, "rb") as f:
+			fields = []
+			rest = ""
+			header = 3
+			while True:
+				data = f.read(bufferSize)
+				if len(data) == 0:
+					break
+				chunk = (rest + data).split("\0")
+				rest = chunk.pop()
+				if header > 0:
+					skipped = min(header, len(chunk))
+					del chunk[:skipped]
+					header -= skipped
+				fields.extend(chunk)
+				entries = len(fields) / self.MANIFEST_FIELDS
+				for i in xrange(entries):
+					yield (fields[i * self.MANIFEST_FIELDS], tuple(fields[i * self.MANIFEST_FIELDS + 1:(i + 1) * self.MANIFEST_FIELDS]))
+				del fields[:entries * self.MANIFEST_FIELDS]
+
+	def layDown(self, targetDirectory):
+		executeCommand("tar -C %s -cf - -b 2048 --one-file-system . | tar -C %s -xpBf - -b 2048" % (pipes.quote(self.seedDirectory), pipes.quote(targetDirectory)))
+
+	# copy all entries of the SD root partition which differ from the seed and remove all entries
+	# of the seed which don't exist on the SD root partition. Hardlinks are recreated from the
+	# first link of each inode, also if only some of the links differ from the seed.
+	# The SD root partition is walked in the order of the manifest, so both are merged while
+	# streaming. Each of the tracking tables keeps at most budget bytes in memory
+	# returns (copied entries, all entries, copied bytes, removed entries)
+
+	def copyDelta(self, sourceDirectory, targetDirectory, rules=None, budget=InodeTable.DEFAULT_BUDGET):
+		global logger
+
+		manifest = self.readManifest()
+		seedEntry = next(manifest, None)
+		entries = 0
+		copied = 0
+		copiedBytes = 0
+		removed = 0
+		directories = DirectoryTable(budget, targetDirectory)
+		inodes = InodeTable(budget, targetDirectory)
+		# inodes of the seed which are already used by the first link of an inode
+		claimed = InodeTable(budget, targetDirectory)
+		# (path, directory) of the directories on the current path
+		parents = [(sourceDirectory, DirectoryTable.ROOT)]
+
+		try:
+			for (path, st) in walkFilesystem(sourceDirectory, rules=rules):
+				entries += 1
+				(parentPath, name) = os.path.split(path)
+				while parents[-1][0] != parentPath:
+					parents.pop()
+				currentDirectory = parents[-1][1]
+				relativePath = os.path.relpath(path, sourceDirectory)
+				targetPath = os.path.join(targetDirectory, relativePath)
+				description = Seeder.describe(path, st)
+
+				# seed entries before the current path don't exist on the SD root partition
+				key = pathKey(relativePath)
+				while seedEntry is not None and pathKey(seedEntry[0]) < key:
+					Seeder.remove(os.path.join(targetDirectory, seedEntry[0]))
+					removed += 1
+					seedEntry = next(manifest, None)
+				expected = None
+				if seedEntry is not None and seedEntry[0] == relativePath:
+					expected = seedEntry[1]
+					seedEntry = next(manifest, None)
+
+				if expected is not None and expected[0] != description[0]:
+					Seeder.remove(targetPath)
+					expected = None
+
+				# directory attributes are set after all entries are copied
+				if description[0] == "d":
+					# directories missing in the seed may have been created by mkfs, e.g. lost+found
+					if expected is None and not os.path.isdir(targetPath):
+						os.mkdir(targetPath, 0700)
+					if expected is None:
+						copied += 1
+					parents.append((path, directories.add(currentDirectory, name, st)))
+					continue
+
+				name = directories.intern(name) if st.st_nlink > 1 else None
+				if name is not None:
+					firstLink = inodes.get(st.st_ino)
+					if firstLink is not None:
+						linkPath = os.path.join(targetDirectory, directories.getPath(firstLink[0]), directories.getName(firstLink[1]))
+						if os.path.lexists(targetPath):
+							os.remove(targetPath)
+						os.link(linkPath, targetPath)
+						if expected != description:
+							copied += 1
+						continue
+					inodes.add(st.st_ino, currentDirectory, name)
+
+				# the seed may link entries which are not linked on the SD root partition
+				if expected == description and description[0] == "f":
+					targetStat = os.lstat(targetPath)
+					if targetStat.st_nlink > 1:
+						if name is None or claimed.get(targetStat.st_ino) is not None:
+							expected = None
+						else:
+							claimed.add(targetStat.st_ino, currentDirectory, name)
+				if expected != description:
+					copyEntry(path, targetPath, st)
+					copied += 1
+					if description[0] == "f":
+						copiedBytes += st.st_size
+			# remaining seed entries don't exist on the SD root partition
+			while seedEntry is not None:
+				Seeder.remove(os.path.join(targetDirectory, seedEntry[0]))
+				removed += 1
+				seedEntry = next(manifest, None)
+			logger.debug("delta: %d of %d entries - removed: %d" % (copied, entries, removed))
+
+			directories.apply(targetDirectory)
+		finally:
+			logger.debug("hardlinked inodes: %d - spills: %d - directories: %d - spills: %d" % (len(inodes), inodes.spills, len(directories), directories.spills))
+			inodes.close()
+			claimed.close()
+			directories.close()
+			manifest.close()
+
+		return (copied, entries, copiedBytes, removed)
+
+# minimal inotify binding, python 2 has no inotify support in the standard library
+
+class Inotify(object):
+
+	IN_MODIFY = 0x00000002
+	IN_ATTRIB = 0x00000004
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_FROM = 0x00000040
+	IN_MOVED_TO = 0x00000080
+	IN_CREATE = 0x00000100
+	IN_DELETE = 0x00000200
+	IN_DELETE_SELF = 0x00000400
+	IN_Q_OVERFLOW = 0x00004000
+	IN_IGNORED = 0x00008000
+	IN_ONLYDIR = 0x01000000
+	IN_DONT_FOLLOW = 0x02000000
+	IN_ISDIR = 0x40000000
+
+	__EVENT_HEADER = "iIII"
+
+	def __init__(self):
+		self.__libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		self.fd = self.__libc.inotify_init()
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init failed")
+
+	# returns the watch descriptor or raises OSError, e.g. with ENOSPC if max_user_watches is exhausted
+	def addWatch(self, path, mask):
+		wd = self.__libc.inotify_add_watch(self.fd, path, mask | self.IN_ONLYDIR | self.IN_DONT_FOLLOW)
+		if wd < 0:
+			errno = ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno), path)
+		return wd
+
+	# returns a list of (wd, mask, name) or an empty list if nothing happened within timeout seconds
+	def read(self, timeout):
+		(readable, writable, exceptional) = select.select([self.fd], [], [], timeout)
+		if len(readable) == 0:
+			return []
+		buffer = os.read(self.fd, 64 * 1024)
+		events = []
+		headerSize = struct.calcsize(self.__EVENT_HEADER)
+		offset = 0
+		while offset + headerSize <= len(buffer):
+			(wd, mask, cookie, length) = struct.unpack_from(self.__EVENT_HEADER, buffer, offset)
+			name = buffer[offset + headerSize:offset + headerSize + length].rstrip('\0')
+			events.append((wd, mask, name))
+			offset += headerSize + length
+		return events
+
+	def close(self):
+		os.close(self.fd)
+
+# keeps the old SD root partition as a warm standby of the moved root partition
+#
+# Changed paths are collected with inotify and coalesced in memory. When the oldest change
+# reaches the maximum staleness all changes are written in one rate limited rsync which
+# writes changed blocks only. Deleted paths are removed with --delete-missing-args.
+# If inotify events are lost or there are too many changes a full rsync is done instead.
+# If there are not enough inotify watches for all directories a full rsync is done periodically.
+
+class Replicator(object):
+
+	WATCH_MASK = Inotify.IN_MODIFY | Inotify.IN_ATTRIB | Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO | Inotify.IN_CREATE | Inotify.IN_DELETE | Inotify.IN_DELETE_SELF
+
+	# /etc/fstab of the SD root partition has to keep the SD root partition
+	DEFAULT_EXCLUDES = [ "/etc/fstab", "/lost+found", "/tmp/*", "/var/tmp/*", "/var/cache/apt/*", "/var/lib/apt/lists/*", "/var/swap", "/home/*/.cache/" ]
+
+	MAX_PENDING = 50000
+	MOUNTPOINT = "/run/%s.sd" % MYNAME
+	RSYNC = "ionice -c2 -n7 nice -n19 rsync -aH --inplace --no-whole-file --numeric-ids"
+
+	def __init__(self, sourceDirectory, sdPartition, excludes, staleness, bandwidth, report=None):
+		self.report = report
+		self.sourceDirectory = sourceDirectory
+		self.sdPartition = sdPartition
+		self.rules = ExclusionRules(sourceDirectory, self.DEFAULT_EXCLUDES + excludes)
+		self.staleness = staleness
+		self.bandwidth = bandwidth
+		self.__rootDevice = os.lstat(sourceDirectory).st_dev
+		self.__inotify = None
+		self.__watches = {}
+		self.__paths = set()
+		self.__trees = set()
+		self.__fullResync = True
+		self.__periodic = False
+		self.__oldestChange = None
+		self.__mountpoint = None
+		self.__mounted = False
+
+	def __note(self, message, *messageArguments):
+		if self.report is not None:
+			self.report(message, *messageArguments)
+
+	def __watch(self, directory):
+		global logger
+		try:
+			wd = self.__inotify.addWatch(directory, self.WATCH_MASK)
+			self.__watches[wd] = directory
+		except OSError, e:
+			if e.errno == errno.ENOSPC:
+				logger.debug("inotify watches exhausted at %s" % (directory))
+				raise
+			# directory vanished in between
+			return
+		for (path, st) in walkFilesystem(directory, self.__rootDevice, self.rules):
+			if stat.S_ISDIR(st.st_mode) and st.st_dev == self.__rootDevice:
+				try:
+					wd = self.__inotify.addWatch(path, self.WATCH_MASK)
+					self.__watches[wd] = path
+				except OSError, e:
+					if e.errno == errno.ENOSPC:
+						raise
+
+	def __changed(self, path, tree=False, isDirectory=False):
+		if self.rules.isExcluded(path, tree or isDirectory):
+			return
+		if self.__oldestChange is None:
+			self.__oldestChange = time.time()
+		if self.__fullResync:
+			return
+		if tree:
+			self.__trees.add(path)
+		else:
+			self.__paths.add(path)
+		if len(self.__paths) + len(self.__trees) > self.MAX_PENDING:
+			self.__fullResync = True
+			self.__paths.clear()
+			self.__trees.clear()
+
+	def __process(self, events):
+		for (wd, mask, name) in events:
+			if mask & Inotify.IN_Q_OVERFLOW:
+				self.__note(MessageCatalog.MSG_REPLICATION_EVENTS_LOST)
+				self.__fullResync = True
+				self.__changed(self.sourceDirectory)
+				continue
+			if mask & Inotify.IN_IGNORED:
+				self.__watches.pop(wd, None)
+				continue
+			directory = self.__watches.get(wd)
+			if directory is None:
+				continue
+			path = os.path.join(directory, name) if name else directory
+			# excluded directories are neither watched nor replicated
+			if self.rules.isExcluded(path, (mask & Inotify.IN_ISDIR) != 0):
+				continue
+			if mask & Inotify.IN_ISDIR and mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+				# files may have been created before the watch was added, so copy the whole tree
+				try:
+					self.__watch(path)
+				except OSError:
+					self.__periodic = True
+				self.__changed(path, tree=True)
+			else:
+				self.__changed(path, isDirectory=(mask & Inotify.IN_ISDIR) != 0)
+
+	def __relative(self, paths):
+		return "\n".join(os.path.relpath(path, self.sourceDirectory) for path in sorted(paths)) + "\n"
+
+	def __rsync(self, options, filesFrom=None):
+		global logger
+		with tempfile.NamedTemporaryFile(dir="/run", prefix=MYNAME) as filterFile:
+			filterFile.write(self.rules.getRsyncFilter())
+			filterFile.flush()
+			command = "%s -x --bwlimit=%d --filter='merge %s' %s" % (self.RSYNC, self.bandwidth, filterFile.name, options)
+			if filesFrom is not None:
+				with tempfile.NamedTemporaryFile(dir="/run", prefix=MYNAME) as listFile:
+					listFile.write(filesFrom)
+					listFile.flush()
+					(rc, result) = executeCommand("%s --files-from=%s %s/ %s/" % (command, listFile.name, self.sourceDirectory.rstrip('/'), self.__mountpoint), noRC=False)
+			else:
+				(rc, result) = executeCommand("%s --delete %s/ %s/" % (command, self.sourceDirectory.rstrip('/'), self.__mountpoint), noRC=False)
+		# 24: files vanished on source side
+		if rc not in (0, 24):
+			raise Exception("rsync to %s failed with rc %d" % (self.__mountpoint, rc))
+		logger.debug("rsync %s rc %d" % (options, rc))
+
+	def flush(self):
+		if self.__oldestChange is None:
+			return
+		changes = len(self.__paths) + len(self.__trees)
+		logEvent("replication", changes=changes, full=self.__fullResync, staleness=int(time.time() - self.__oldestChange))
+		if self.__fullResync:
+			self.__fullResync = False
+			self.__rsync("")
+		else:
+			if len(self.__paths) > 0:
+				self.__rsync("--delete-missing-args", self.__relative(self.__paths))
+			if len(self.__trees) > 0:
+				self.__rsync("-r --delete", self.__relative(self.__trees))
+		if changes > 0:
+			self.__note(MessageCatalog.MSG_REPLICATED, changes, self.sdPartition, int(time.time() - self.__oldestChange))
+		else:
+			self.__note(MessageCatalog.MSG_RESYNCHRONIZED, self.sourceDirectory, self.sdPartition)
+		self.__paths.clear()
+		self.__trees.clear()
+		self.__oldestChange = None
+
+	def __mount(self):
+		mountpoint = DeviceManager().getMountpoint(self.sdPartition)
+		if mountpoint is not None:
+			self.__mountpoint = mountpoint
+			return
+		if not os.path.exists(self.MOUNTPOINT):
+			os.makedirs(self.MOUNTPOINT)
+		executeCommand("mount -o noatime %s %s" % (self.sdPartition, self.MOUNTPOINT))
+		self.__mountpoint = self.MOUNTPOINT
+		self.__mounted = True
+
+	def run(self):
+		self.__mount()
+		self.__inotify = Inotify()
+		try:
+			try:
+				self.__watch(self.sourceDirectory)
+			except OSError:
+				self.__note(MessageCatalog.MSG_REPLICATION_WATCHES_EXHAUSTED, len(self.__watches))
+				self.__periodic = True
+
+			self.__note(MessageCatalog.MSG_REPLICATING, self.sourceDirectory, self.sdPartition, self.staleness, len(self.__watches))
+
+			# the initial full resync brings the SD root partition up to date
+			self.__oldestChange = time.time()
+			self.flush()
+
+			while True:
+				self.__process(self.__inotify.read(self.staleness))
+				# not all directories are watched, so resynchronize everything periodically
+				if self.__periodic and self.__oldestChange is None:
+					self.__oldestChange = time.time()
+					self.__fullResync = True
+				if self.__oldestChange is not None and time.time() - self.__oldestChange >= self.staleness:
+					self.flush()
+		finally:
+			self.__inotify.close()
+			try:
+				self.flush()
+			finally:
+				if self.__mounted:
+					executeCommand("umount %s" % (self.__mountpoint))
+
 # stderr and stdout logger 
 
 class MyLogger(object):
@@ -659,31 +2427,200 @@ class MyLogger(object):
 		if len(message.rstrip()) > 1:
 			self.logger.log(self.level, message.rstrip())
 
+# python 2 has no logging.handlers.QueueHandler, so records are just queued and written by the LogListener
+
+class QueueHandler(logging.Handler):
+
+	def __init__(self, queue):
+		logging.Handler.__init__(self)
+		self.queue = queue
+
+	def emit(self, record):
+		self.queue.put_nowait(record)
+
+# rotating file handler which flushes only if the LogListener finished a batch of records.
+# RotatingFileHandler.shouldRollover seeks to the end of the file for every record, which flushes
+# the buffer, so the size of the file is counted instead
+
+class BatchingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+
+	def __init__(self, filename, maxBytes=0, backupCount=0):
+		logging.handlers.RotatingFileHandler.__init__(self, filename, maxBytes=maxBytes, backupCount=backupCount)
+		self.__size = os.path.getsize(self.baseFilename) if os.path.exists(self.baseFilename) else 0
+		self.__recordSize = 0
+
+	def shouldRollover(self, record):
+		self.__recordSize = len(self.format(record)) + 1
+		return self.maxBytes > 0 and self.__size > 0 and self.__size + self.__recordSize > self.maxBytes
+
+	def doRollover(self):
+		logging.handlers.RotatingFileHandler.doRollover(self)
+		self.__size = 0
+
+	def emit(self, record):
+		logging.handlers.RotatingFileHandler.emit(self, record)
+		self.__size += self.__recordSize
+
+	def flush(self):
+		pass
+
+	def flushBatch(self):
+		if self.stream is not None:
+			self.stream.flush()
+
+# writes queued records in a background thread in batches of at most BATCH_SIZE records or FLUSH_INTERVAL seconds
+
+class LogListener(threading.Thread):
+
+	BATCH_SIZE = 512
+	FLUSH_INTERVAL = 1.0
+
+	def __init__(self, queue, *handlers):
+		threading.Thread.__init__(self, name="LogListener")
+		self.daemon = True
+		self.queue = queue
+		self.handlers = handlers
+
+	def __handle(self, record):
+		for handler in self.handlers:
+			if record.levelno >= handler.level and handler.filter(record):
+				handler.handle(record)
+
+	def run(self):
+		stopped = False
+		while not stopped:
+			record = self.queue.get()
+			batchStart = time.time()
+			batch = 0
+			while record is not None:
+				self.__handle(record)
+				batch += 1
+				if batch >= self.BATCH_SIZE:
+					break
+				try:
+					record = self.queue.get(True, max(batchStart + self.FLUSH_INTERVAL - time.time(), 0.001))
+				except Queue.Empty:
+					break
+			stopped = record is None
+			for handler in self.handlers:
+				handler.flushBatch()
+
+	def stop(self):
+		if self.is_alive():
+			self.queue.put(None)
+			self.join()
+		for handler in self.handlers:
+			handler.close()
+
+# JSON lines of the events logged with logEvent
+
+class EventFormatter(logging.Formatter):
+
+	def format(self, record):
+		event = { "ts": round(record.created, 3), "event": record.getMessage() }
+		event.update(record.fields)
+		return json.dumps(event, sort_keys=True)
+
+# only records logged with logEvent have fields
+
+class EventFilter(logging.Filter):
+
+	def __init__(self, events):
+		logging.Filter.__init__(self)
+		self.events = events
+
+	def filter(self, record):
+		return hasattr(record, "fields") == self.events
+
+def logEvent(event, **fields):
+	eventLogger.info(event, extra={ "fields": fields })
+
+# logs start, end, duration and success of a phase of the migration
+
+class Phase(object):
+
+	def __init__(self, name):
+		self.name = name
+		self.start = None
+
+	def __enter__(self):
+		self.start = time.time()
+		logEvent("phase_start", phase=self.name)
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		logEvent("phase_end", phase=self.name, seconds=round(time.time() - self.start, 3), success=excType is None)
+		return False
+
+# structured results of the API functions. Messages are MessageCatalog entries and can be
+# localized with MessageCatalog.getLocalizedMessage(message, *arguments). Verdicts which don't
+# decide the eligibility of a partition have eligible None
+
+Verdict = collections.namedtuple("Verdict", "partition eligible message arguments")
+Eligibility = collections.namedtuple("Eligibility", "sourceRootPartition sourceRootType sourceRootSize sourceRootUsed candidates eligiblePartitions verdicts excludedBytes")
+CopyResult = collections.namedtuple("CopyResult", "sourceDirectory targetDirectory copiedBytes seconds")
+BootConfiguration = collections.namedtuple("BootConfiguration", "targetID fstabFile cmdFile savedCmdFile")
+IOTuning = collections.namedtuple("IOTuning", "partition profile settings changes diff")
+
+# raised by the API functions if the migration is not possible
+
+class MigrationError(Exception):
+
+	def __init__(self, message, *messageArguments):
+		Exception.__init__(self, MessageCatalog.getLocalizedMessage(message, *messageArguments))
+		self.catalogMessage = message
+		self.messageArguments = messageArguments
+		self.messageId = MessageCatalog.getMessageId(message)
+
+def printMessage(message, *messageArguments):
+	print MessageCatalog.getLocalizedMessage(message, *messageArguments)
+
 # detect all available partitions on system
 
-def collectEligiblePartitions():
+def detectPartitions():
+	return DeviceManager().getAllDetected()
+
+# check all partitions whether they are eligible as new root partition
+# report is called with every message and its arguments, e.g. printMessage
+# Space used by entries excluded by rules (ExclusionRules) is not required on the target partition
+
+def collectEligiblePartitions(force=False, convert=None, report=None, rules=None):
 
 	global logger
-	
+
+	verdicts = []
+
+	def note(message, *messageArguments):
+		if report is not None:
+			report(message, *messageArguments)
+
+	def verdict(partition, eligible, message, *messageArguments):
+		verdicts.append(Verdict(partition, eligible, message, (partition,) + messageArguments))
+		logEvent("eligibility", partition=partition, verdict=MessageCatalog.getMessageId(message), eligible=eligible)
+		note(message, partition, *messageArguments)
+
 	dm = DeviceManager()				
 					
 	(cmdPartition, cmdType) = dm.getSDPartitions()
 	logger.debug("cmdPartition %s - %s " % (cmdPartition, cmdType))
 
 	if cmdPartition != ROOT_PARTITION:
-		print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_ROOTPARTITION_NOT_ON_SDCARD, cmdPartition)
-		sys.exit(-1)
+		raise MigrationError(MessageCatalog.MSG_ROOTPARTITION_NOT_ON_SDCARD, cmdPartition)
 		
 	availableTargetPartitions = []
 	
 	for partition in dm.getPartitions():
 		if not partition.startswith(SSD_DEVICE):
-			if dm.getType(partition) != cmdType:
-				print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_PARTITION_INVALID_TYPE, partition, dm.getType(partition))
+			if convert is not None:
+				if dm.getType(partition) != convert:
+					verdict(partition, None, MessageCatalog.MSG_PARTITION_WILL_BE_CONVERTED, dm.getType(partition), convert)
+				availableTargetPartitions.append(partition)
+			elif dm.getType(partition) != cmdType:
+				verdict(partition, False, MessageCatalog.MSG_PARTITION_INVALID_TYPE, dm.getType(partition))
 			else:
 				availableTargetPartitions.append(partition)
 
-	print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_TARGET_PARTITION_CANDIDATES, ' '.join(availableTargetPartitions))
+	note(MessageCatalog.MSG_TARGET_PARTITION_CANDIDATES, ' '.join(availableTargetPartitions))
 	
 	sourceRootPartition = ROOT_PARTITION
 	sourceRootType = dm.getType(ROOT_PARTITION)
@@ -692,10 +2629,17 @@ def collectEligiblePartitions():
 	sourceRootUsed = sourceRootSize - sourceRootFree
 	
 	if cmdPartition != sourceRootPartition:
-		print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_ROOT_ALREADY_MOVED, cmdPartition)
-		sys.exit(-1) 
+		raise MigrationError(MessageCatalog.MSG_ROOT_ALREADY_MOVED, cmdPartition)
+
+	excludedBytes = 0
+	if rules is not None and len(rules) > 0:
+		sourceDirectory = dm.getMountpoint(sourceRootPartition)
+		(excluded, excludedBytes) = collectExcluded(sourceDirectory, ExclusionRules(sourceDirectory, rules.patterns))
+		note(MessageCatalog.MSG_EXCLUDED, len(excluded), asReadable(excludedBytes), sourceRootPartition)
+		logEvent("excluded", entries=len(excluded), excludedBytes=excludedBytes)
+		sourceRootUsed = max(sourceRootUsed - excludedBytes, 0)
 
-	print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_SOURCE_ROOT_PARTITION, sourceRootPartition, asReadable(sourceRootSize), asReadable(sourceRootUsed), sourceRootType)
+	note(MessageCatalog.MSG_SOURCE_ROOT_PARTITION, sourceRootPartition, asReadable(sourceRootSize), asReadable(sourceRootUsed), sourceRootType)
 		
 	validTargetPartitions = []
 
@@ -703,35 +2647,35 @@ def collectEligiblePartitions():
 						
 	for partition in availableTargetPartitions:
 
-		print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_TESTING_PARTITION, partition, asReadable(dm.getSize(partition)), asReadable(dm.getFree(partition)), dm.getType(partition))
+		note(MessageCatalog.MSG_TESTING_PARTITION, partition, asReadable(dm.getSize(partition)), asReadable(dm.getFree(partition)), dm.getType(partition))
 		partitionMountPoint = dm.getMountpoint(partition)
 		logger.debug("partitionMountPoint: %s" % (partitionMountPoint))
 
 		if partitionMountPoint is None:
-			print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_PARTITION_NOT_MOUNTED, partition)
+			verdict(partition, False, MessageCatalog.MSG_PARTITION_NOT_MOUNTED)
 
 		elif dm.getSize(partition) < sourceRootSize:
 			if not force:
 				if dm.getSize(partition) < sourceRootSize and dm.getFree(partition) < sourceRootUsed:
-					print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_PARTITION_TOO_SMALL, partition, asReadable(dm.getSize(partition)))							
+					verdict(partition, False, MessageCatalog.MSG_PARTITION_TOO_SMALL, asReadable(dm.getSize(partition)))							
 				else:
-					print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_PARTITION_TOO_SMALL_BUT_FREE_OK, partition, asReadable(dm.getSize(partition)), asReadable(dm.getFree(partition)))
+					verdict(partition, False, MessageCatalog.MSG_PARTITION_TOO_SMALL_BUT_FREE_OK, asReadable(dm.getSize(partition)), asReadable(dm.getFree(partition)))
 					
 			else:
 				if dm.getFree(partition) < sourceRootUsed:
 					logger.debug("free(%s): %s - sourceRootUsed: %s" % (partition, dm.getFree(partition), sourceRootUsed))
-					print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_PARTITION_FREE_SPACE_TOO_SMALL, partition, asReadable(dm.getFree(partition)))			
+					verdict(partition, False, MessageCatalog.MSG_PARTITION_FREE_SPACE_TOO_SMALL, asReadable(dm.getFree(partition)))			
 				else:
 					logger.debug("free(%s): %s - sourceRootSize: %s" % (partition, dm.getFree(partition), sourceRootSize))
-					print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_TARGET_PARTITION_SMALLER_THAN_SOURE_PARTITION, partition, asReadable(dm.getFree(partition)), asReadable(sourceRootSize))
+					verdict(partition, True, MessageCatalog.MSG_TARGET_PARTITION_SMALLER_THAN_SOURE_PARTITION, asReadable(dm.getFree(partition)), asReadable(sourceRootSize))
 					validTargetPartitions.append(partition)
 
-		elif dm.getType(partition) != sourceRootType:
+		elif convert is None and dm.getType(partition) != sourceRootType:
 			logger.debug("type(%s): %s - sourceRootSize: %s" % (partition, dm.getType(partition), sourceRootSize))
-			print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_PARTITION_INVALID_TYPE, partition, dm.getType(partition))
+			verdict(partition, False, MessageCatalog.MSG_PARTITION_INVALID_TYPE, dm.getType(partition))
 
 		elif multipleDevices and not dm.isGPT(partition):
-			print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_PARTITION_INVALID_FILEPARTITION, partition, dm.getPartitiontableType(partition))
+			verdict(partition, False, MessageCatalog.MSG_PARTITION_INVALID_FILEPARTITION, dm.getPartitiontableType(partition))
 
 		elif partition != sourceRootPartition:
 			diskFilesTgt = int(executeCommand('ls -A ' + partitionMountPoint + ' | wc -l'))
@@ -741,153 +2685,383 @@ def collectEligiblePartitions():
 			
 			if (diskFilesTgt == 1 and lostDir == 1) or (lostDir == 0 and diskFilesTgt == 0) or piHome:
 				validTargetPartitions.append(partition)
+				verdicts.append(Verdict(partition, True, MessageCatalog.MSG_ELIGIBLE_AS_ROOT, (partition,)))
+				logEvent("eligibility", partition=partition, verdict=MessageCatalog.getMessageId(MessageCatalog.MSG_ELIGIBLE_AS_ROOT), eligible=True)
 			else:
-				print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_PARTITION_NOT_EMPTY, partition)
+				verdict(partition, False, MessageCatalog.MSG_PARTITION_NOT_EMPTY)
 
 		else:
-			print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_PARTITION_UNKNOWN_SKIP, partition)
+			verdict(partition, False, MessageCatalog.MSG_PARTITION_UNKNOWN_SKIP)
 							
-	return validTargetPartitions, sourceRootPartition 
-			
-##################################################################################
-################################### Main #########################################
-##################################################################################
+	return Eligibility(sourceRootPartition, sourceRootType, sourceRootSize, sourceRootUsed, availableTargetPartitions, validTargetPartitions, verdicts, excludedBytes)
 
-LOG_FILENAME = "./%s.log" % MYNAME
-LOG_LEVEL = logging.INFO 
-force=False
+# copy the root partition to the mounted target partition, either tuned, with one tar pipe or
+# as delta to a golden image or reference tree. Entries excluded by rules are not copied and
+# swap files are created on the target partition instead of being copied
 
-logLevels = { "INFO": logging.INFO , "DEBUG": logging.DEBUG, "WARNING": logging.WARNING }
+def copyRootPartition(sourceRootPartition, targetRootPartition, seedFrom=None, tune=True, report=None, rules=None):
 
-parser = argparse.ArgumentParser(description="Move SD root partition to external partition on Raspberry Pi")
-parser.add_argument("-l", "--log", help="log file (default: " + LOG_FILENAME + ")")
-parser.add_argument("-d", "--debug", help="debug level %s (default: %s)" % ('|'.join(logLevels.keys()), logLevels.keys()[logLevels.values().index(LOG_LEVEL)]))
-parser.add_argument("-g", "--language", help="message language %s (default: %s)" % ('|'.join(MessageCatalog.getSupportedLocales()), MessageCatalog.getDefaultLocale()))
-parser.add_argument("-f", "--force", help="allow target partitions which are smaller than the source partition", action='store_true')
+	global logger
 
-args = parser.parse_args()
-if args.log:
-	LOG_FILENAME = args.log
+	def note(message, *messageArguments):
+		if report is not None:
+			report(message, *messageArguments)
 
-if args.language:
-	if MessageCatalog.isSupportedLocale(args.language):
-		MessageCatalog.setLocale(args.language)
-	else:
-		print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_INVALID_LANGUAGE, args.language)
-		sys.exit(-1)
+	dm = DeviceManager()
+	sourceDirectory = dm.getMountpoint(sourceRootPartition)
+	targetDirectory = dm.getMountpoint(targetRootPartition)
+	logger.debug("sourceDirectory: %s - targetDirectory: %s" % (sourceDirectory, targetDirectory))
 
-if args.debug:
-	if args.debug in logLevels:
-		LOG_LEVEL = logLevels[args.debug]
-	else:
-		print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_INVALID_LOG_LEVEL, args.debug)
-		sys.exit(-1)
+	start = time.time()
+	copiedBytes = None
+
+	# rules are relative to the mountpoint of the source partition
+	swapFiles = detectSwapFiles(sourceDirectory)
+	rules = ExclusionRules(sourceDirectory, (rules.patterns if rules is not None else []) + ["/" + swapFile for (swapFile, size) in swapFiles])
+
+	with Phase("copy"):
+		note(MessageCatalog.MSG_COPYING_ROOT)
+		if seedFrom:
+			seeder = Seeder(seedFrom)
+			seeder.attach()
+			try:
+				if not seeder.isTree() and not seeder.isManifestCurrent():
+					note(MessageCatalog.MSG_SEED_MANIFEST, seeder.manifestFile, seedFrom)
+					seeder.buildManifest()
+				note(MessageCatalog.MSG_SEEDING, seedFrom, targetRootPartition)
+				seeder.layDown(targetDirectory)
+			finally:
+				seeder.detach()
+			if seeder.isTree():
+				note(MessageCatalog.MSG_SEED_MANIFEST, seeder.manifestFile, seedFrom)
+				seeder.buildManifest(targetDirectory)
+			(copied, entries, copiedBytes, removed) = seeder.copyDelta(sourceDirectory, targetDirectory, rules)
+			note(MessageCatalog.MSG_SEED_DELTA, copied, entries, asReadable(copiedBytes), removed, sourceRootPartition)
+			logEvent("seed_delta", copied=copied, entries=entries, copiedBytes=copiedBytes, removed=removed)
+		elif not tune:
+			(excluded, excludedBytes) = collectExcluded(sourceDirectory, rules)
+			with tempfile.NamedTemporaryFile(prefix=MYNAME) as excludeFile:
+				excludeFile.write("".join("./%s\n" % (path) for path in excluded))
+				excludeFile.flush()
+				command = "tar -C %s -cf - --one-file-system --checkpoint=1000 --anchored --no-wildcards --exclude-from=%s . | ( cd %s; tar xfp -)" % (sourceDirectory, excludeFile.name, targetDirectory)
+				executeCommand(command)
+		else:
+			tuner = CopyTuner(sourceRootPartition, targetRootPartition, report, rules)
+			(bufferSize, workers, maxWorkers) = tuner.calibrate(targetDirectory)
+			note(MessageCatalog.MSG_COPY_TUNING, asReadable(bufferSize), workers, maxWorkers)
+			copiedBytes = tuner.copy(sourceDirectory, targetDirectory)
 
-if args.force:
-	force=True	
+		createSwapFiles(targetDirectory, swapFiles, dm.getType(targetRootPartition))
+		for (swapFile, size) in swapFiles:
+			note(MessageCatalog.MSG_SWAPFILE_CREATED, "/" + swapFile, asReadable(size), targetRootPartition)
 
-# setup logging
+	return CopyResult(sourceDirectory, targetDirectory, copiedBytes, round(time.time() - start, 3))
 
-if os.path.isfile(LOG_FILENAME):
-	os.remove(LOG_FILENAME)
-	
-logger = logging.getLogger(__name__)
-logger.setLevel(LOG_LEVEL)
-handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, backupCount=1)
-formatter = logging.Formatter('%(asctime)s %(levelname)-8s %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+# update fstab on the target partition and cmdline.txt on the SD card to boot from the target partition
 
-sys.stdout = MyLogger(sys.stdout, logger, logging.INFO)
-sys.stderr = MyLogger(sys.stderr, logger, logging.ERROR)
+def updateBootConfiguration(sourceRootPartition, targetRootPartition, converter=None, report=None):
 
-# doit now
+	global logger
 
-if os.geteuid() != 0: 
-	print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_NEEDS_ROOT)
-  	sys.exit(-1)
+	def note(message, *messageArguments):
+		if report is not None:
+			report(message, *messageArguments)
 
-try:
+	dm = DeviceManager()
+	sourceDirectory = dm.getMountpoint(sourceRootPartition)
+	targetDirectory = dm.getMountpoint(targetRootPartition)
 
-	print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_VERSION, GIT_CODEVERSION)
-	print LICENSE
-	print
+	with Phase("boot_config"):
+		if dm.isGPT(targetRootPartition):
+			targetID = "PARTUUID=" + dm.getGUID(targetRootPartition)	
+		else:
+			targetID = targetRootPartition
+		logger.debug("targetID: %s " % (targetID))
+
+		# check if root partition is already used in fstab
+		command = 'grep -q "%s" %s/etc/fstab' % (targetRootPartition, targetDirectory)
+		(rc, result) = executeCommand(command, noRC = False)
+		if rc == 0:
+			note(MessageCatalog.MSG_FOUND_IN_FSTAB, targetRootPartition)
+			command = 'sed -i "s|^%s|# commented out by %s|g" %s/etc/fstab' % (targetRootPartition, MYNAME, targetDirectory)
+			executeCommand(command)
 	
-	print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_DETECTED_PARTITIONS)
-	partitions = DeviceManager().getAllDetected()
-	for partition in partitions:
-		print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_DETECTED_PARTITION, partition[0], asReadable(partition[1]), asReadable(partition[2]), partition[3], partition[4], partition[5])
-		
-	(validTargetPartitions, sourceRootPartition) = collectEligiblePartitions()
+		# change /etc/fstab on target
+		command = "sed -i \"s|%s|%s|\" %s/etc/fstab" % (sourceRootPartition, targetID, targetDirectory)
+		note(MessageCatalog.MSG_UPDATING_FSTAB, targetRootPartition)
+		executeCommand(command)
+		if converter is not None:
+			converter.updateFstab(targetDirectory + "/etc/fstab")
+	
+		# create backup copy of old cmdline.txt
+		command = "cp -a %s %s; chmod -w %s" % (CMD_FILE, CMD_FILE+".sd", CMD_FILE+".sd")	
+		note(MessageCatalog.MSG_SAVING_OLD_CMDFILE, CMD_FILE, sourceRootPartition, CMD_FILE+".sd")
+		executeCommand(command)
+	
+		# update cmdline.txt	
+		command = "sed -i \"s|root=[^ ]\+|root=%s|g\" %s/%s" % (targetID, sourceDirectory, CMD_FILE)
+		note(MessageCatalog.MSG_UPDATING_CMDFILE, CMD_FILE, targetRootPartition)
+		executeCommand(command)
+		if converter is not None:
+			converter.updateCmdline("%s/%s" % (sourceDirectory, CMD_FILE))
+
+	return BootConfiguration(targetID, targetDirectory + "/etc/fstab", "%s/%s" % (sourceDirectory, CMD_FILE), CMD_FILE + ".sd")
+
+# inspect the device of the root partition of the migrated system and collect the changes of
+# fstab, cmdline.txt, udev rules and fstrim.timer which tune the I/O stack for it
+
+def planIOTuning(rootPartition, rootDirectory, cmdFile, report=None):
+
+	def note(message, *messageArguments):
+		if report is not None:
+			report(message, *messageArguments)
+
+	tuner = IOTuner(rootPartition, DeviceManager().getType(rootPartition))
+	profile = tuner.inspect()
+	note(MessageCatalog.MSG_IO_PROFILE, profile.disk, rootPartition, profile.rotational, profile.transport or "-", profile.queueDepth, profile.discard)
+	logEvent("io_profile", partition=rootPartition, **profile._asdict())
+	settings = tuner.getSettings(profile)
+	changes = tuner.plan(settings, rootDirectory, cmdFile)
+	if len(changes) == 0:
+		note(MessageCatalog.MSG_IO_ALREADY_TUNED, rootPartition)
+	return IOTuning(rootPartition, profile, settings, changes, IOTuner.getDiff(changes))
+
+def applyIOTuning(tuning, report=None):
+
+	with Phase("io_tuning"):
+		IOTuner.apply(tuning.changes)
+		logEvent("io_tuning", partition=tuning.partition, files=[change.path for change in tuning.changes])
+	if report is not None:
+		report(MessageCatalog.MSG_IO_TUNED, tuning.partition)
+
+# messages are written to the log file and events as JSON lines to the event file by a background
+# thread. Both files are rotated and keep the history of previous runs
+
+def setupLogging(logFile, logLevel):
+	logger.setLevel(logLevel)
+	handler = BatchingRotatingFileHandler(logFile, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+	handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s'))
+	handler.addFilter(EventFilter(False))
+	eventHandler = BatchingRotatingFileHandler(getEventFilename(logFile), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+	eventHandler.setFormatter(EventFormatter())
+	eventHandler.addFilter(EventFilter(True))
+	logQueue = Queue.Queue()
+	logger.addHandler(QueueHandler(logQueue))
+	logListener = LogListener(logQueue, handler, eventHandler)
+	logListener.start()
+	atexit.register(logListener.stop)
+	return logListener
+
+def getEventFilename(logFile):
+	return os.path.splitext(logFile)[0] + ".events"
+
+##################################################################################
+################################### Main #########################################
+##################################################################################
+
+LOG_FILENAME = "./%s.log" % MYNAME
+LOG_LEVEL = logging.INFO 
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+def main():
+
+	logFile = LOG_FILENAME
+	logLevel = LOG_LEVEL
+	convert = None
+
+	logLevels = { "INFO": logging.INFO , "DEBUG": logging.DEBUG, "WARNING": logging.WARNING }
+
+	parser = argparse.ArgumentParser(description="Move SD root partition to external partition on Raspberry Pi")
+	parser.add_argument("-l", "--log", help="log file. Events are written as JSON lines into the log file with extension .events (default: " + LOG_FILENAME + ")")
+	parser.add_argument("-d", "--debug", help="debug level %s (default: %s)" % ('|'.join(logLevels.keys()), logLevels.keys()[logLevels.values().index(LOG_LEVEL)]))
+	parser.add_argument("-g", "--language", help="message language %s (default: %s)" % ('|'.join(MessageCatalog.getSupportedLocales()), MessageCatalog.getDefaultLocale()))
+	parser.add_argument("-f", "--force", help="allow target partitions which are smaller than the source partition", action='store_true')
+	parser.add_argument("-c", "--convert", help="format the target partition as %s instead of using the SD root partition type" % ('|'.join(FilesystemConverter.getSupportedFilesystems())))
+	parser.add_argument("-p", "--provision", help="erase device (e.g. /dev/sda), create an aligned partition and filesystem and use it as target root partition")
+	parser.add_argument("-e", "--seed-from", help="golden image or reference tree copied to the target partition first. Only files which differ from it are copied from the SD card")
+	parser.add_argument("-r", "--replicate", help="replicate the moved root partition continuously to the SD root partition", action='store_true')
+	parser.add_argument("-x", "--exclude", help="gitignore style path pattern not to copy and replicate, may be used multiple times (replication default: %s)" % (' '.join(Replicator.DEFAULT_EXCLUDES)), action='append', default=[])
+	parser.add_argument("-i", "--rules", help="exclusion rules not to copy and replicate, either a preset %s or a file with one gitignore style pattern per line. May be used multiple times" % ('|'.join(ExclusionRules.getPresets())), action='append', default=[])
+	parser.add_argument("-s", "--staleness", help="maximum age in seconds of changes not yet replicated (default: %(default)s)", type=int, default=300)
+	parser.add_argument("-b", "--bwlimit", help="replication bandwidth limit in KiB/s (default: %(default)s)", type=int, default=1024)
+	parser.add_argument("-n", "--notune", help="copy with a single tar pipe and don't tune the copy to the source and target devices", action='store_true')
+	parser.add_argument("-t", "--iotune", help="tune I/O scheduler, read-ahead, mount options, discard and rootwait for the device of the target partition. If the root partition was already moved the current root partition is tuned. All changes are shown before they are written", action='store_true')
+	parser.add_argument("--dry-run", help="show the changes of --iotune without writing them", action='store_true')
+
+	args = parser.parse_args()
+	if args.log:
+		logFile = args.log
+	
+	if args.language:
+		if MessageCatalog.isSupportedLocale(args.language):
+			MessageCatalog.setLocale(args.language)
+		else:
+			printMessage(MessageCatalog.MSG_INVALID_LANGUAGE, args.language)
+			sys.exit(-1)
+	
+	if args.debug:
+		if args.debug in logLevels:
+			logLevel = logLevels[args.debug]
+		else:
+			printMessage(MessageCatalog.MSG_INVALID_LOG_LEVEL, args.debug)
+			sys.exit(-1)
 	
-	if len(validTargetPartitions) == 0:
-		print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_NO_ELIGIBLE_ROOT)
+	if args.seed_from and not os.path.exists(args.seed_from):
+		printMessage(MessageCatalog.MSG_SEED_INVALID, args.seed_from)
 		sys.exit(-1)
 	
-	print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_ELIGIBLES_AS_ROOT)
-	for partition in validTargetPartitions:
-		print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_ELIGIBLE_AS_ROOT, partition)
-		
-	inputAvailable = False
-	while not inputAvailable:	
-		selection = raw_input(MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_ENTER_PARTITION))
-		inputAvailable = selection in validTargetPartitions
-		if not inputAvailable:
-			print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_PARTITION_INVALIDE, selection)
+	if args.convert:
+		if args.convert in FilesystemConverter.getSupportedFilesystems():
+			convert = args.convert
+		else:
+			printMessage(MessageCatalog.MSG_INVALID_CONVERSION, args.convert)
+			sys.exit(-1)
 	
-	targetRootPartition = selection
+	patterns = []
+	for ruleSet in args.rules:
+		if ruleSet in ExclusionRules.PRESETS:
+			patterns.extend(ExclusionRules.PRESETS[ruleSet])
+		elif os.path.isfile(ruleSet) and os.access(ruleSet, os.R_OK):
+			patterns.extend(ExclusionRules.readPatterns(ruleSet))
+		else:
+			printMessage(MessageCatalog.MSG_RULES_INVALID, ruleSet, '|'.join(ExclusionRules.getPresets()))
+			sys.exit(-1)
+	rules = ExclusionRules("/", patterns + args.exclude)
+
+	setupLogging(logFile, logLevel)
+
+	sys.stdout = MyLogger(sys.stdout, logger, logging.INFO)
+	sys.stderr = MyLogger(sys.stderr, logger, logging.ERROR)
 	
-	dm = DeviceManager()				
+	# doit now
 	
-	sourceDirectory = dm.getMountpoint(sourceRootPartition)
-	targetDirectory = dm.getMountpoint(targetRootPartition)
-	logger.debug("sourceDirectory: %s - targetDirectory: %s" % (sourceDirectory, targetDirectory))
+	if os.geteuid() != 0: 
+		printMessage(MessageCatalog.MSG_NEEDS_ROOT)
+		sys.exit(-1)
 	
-	print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_PARTITION_WILL_BE_COPIED, sourceRootPartition, targetRootPartition)
-	print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_ARE_YOU_SURE)
-	selection = raw_input('')
-	if selection not in ['Y', 'y', 'J', 'j']:
-		sys.exit(0)
+	def tuneIOStack(rootPartition, rootDirectory, cmdFile):
+		tuning = planIOTuning(rootPartition, rootDirectory, cmdFile, printMessage)
+		if len(tuning.changes) == 0:
+			return
+		printMessage(MessageCatalog.MSG_IO_CHANGES, rootPartition)
+		print tuning.diff
+		if args.dry_run:
+			return
+		printMessage(MessageCatalog.MSG_ARE_YOU_SURE)
+		selection = raw_input('')
+		if selection in ['Y', 'y', 'J', 'j']:
+			applyIOTuning(tuning, printMessage)
+
+	try:
 	
-	command = "tar cf - --one-file-system --checkpoint=1000 %s | ( cd %s; tar xfp -)" % (sourceDirectory, targetDirectory)
-	print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_COPYING_ROOT)
-	executeCommand(command)
+		printMessage(MessageCatalog.MSG_VERSION, GIT_CODEVERSION)
+		print LICENSE
+		print
 	
-	if dm.isGPT(targetRootPartition):
-		targetID = "PARTUUID=" + dm.getGUID(targetRootPartition)	
-	else:
-		targetID = targetRootPartition
-	logger.debug("targetID: %s " % (targetID))
-
-	# check if root partition is already used in fstab
-	command = 'grep -q "%s" %s/etc/fstab' % (targetRootPartition, targetDirectory)
-	(rc, result) = executeCommand(command, noRC = False)
-	if rc == 0:
-		print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_FOUND_IN_FSTAB, targetRootPartition)
-		command = 'sed -i "s|^%s|# commented out by %s|g" %s/etc/fstab' % (targetRootPartition, MYNAME, targetDirectory)
-		executeCommand(command)
+		if args.iotune:
+			(cmdPartition, cmdType) = DeviceManager().getSDPartitions()
+			if cmdPartition != ROOT_PARTITION:
+				tuneIOStack(executeCommand("findmnt -n -o SOURCE /").strip(), "/", CMD_FILE)
+				sys.exit(0)
+
+		if args.replicate:
+			(cmdPartition, cmdType) = DeviceManager().getSDPartitions()
+			if cmdPartition == ROOT_PARTITION:
+				printMessage(MessageCatalog.MSG_ROOT_NOT_MOVED, cmdPartition)
+				sys.exit(-1)
+			# systemd stops with SIGTERM, pending changes are replicated before exit
+			signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+			with Phase("replication"):
+				Replicator("/", ROOT_PARTITION, rules.patterns + [os.path.abspath(logFile) + "*", os.path.abspath(getEventFilename(logFile)) + "*"], args.staleness, args.bwlimit, printMessage).run()
 	
-	# change /etc/fstab on target
-	command = "sed -i \"s|%s|%s|\" %s/etc/fstab" % (sourceRootPartition, targetID, targetDirectory)
-	print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_UPDATING_FSTAB, targetRootPartition)
-	executeCommand(command)
+		converter = None
+		if convert is not None:
+			converter = FilesystemConverter(convert)
+			reason = converter.checkSupport()
+			if reason is not None:
+				printMessage(MessageCatalog.MSG_CONVERSION_NOT_SUPPORTED, convert, reason)
+				sys.exit(-1)
+		
+		provisionedPartition = None
+		if args.provision:
+			device = args.provision
+			if device.startswith(SSD_DEVICE_CARD) or not os.path.exists("/sys/block/" + os.path.basename(device)):
+				printMessage(MessageCatalog.MSG_DEVICE_INVALID, device)
+				sys.exit(-1)
+			provisioner = Provisioner(device)
+			mounted = provisioner.getMountedPartitions()
+			if len(mounted) > 0:
+				printMessage(MessageCatalog.MSG_DEVICE_IN_USE, device, ' '.join(mounted))
+				sys.exit(-1)
+			printMessage(MessageCatalog.MSG_DEVICE_WILL_BE_ERASED, device, asReadable(DeviceManager().getSize(device)))
+			printMessage(MessageCatalog.MSG_ARE_YOU_SURE)
+			selection = raw_input('')
+			if selection not in ['Y', 'y', 'J', 'j']:
+				sys.exit(0)
+			filesystem = convert if convert is not None else DeviceManager().getSDPartitions()[1]
+			printMessage(MessageCatalog.MSG_PROVISIONING, provisioner.partition, asReadable(provisioner.getAlignment()), filesystem)
+			with Phase("provision"):
+				provisionedPartition = provisioner.provision(filesystem, ROOT_PARTITION)
 	
-	# create backup copy of old cmdline.txt
-	command = "cp -a %s %s; chmod -w %s" % (CMD_FILE, CMD_FILE+".sd", CMD_FILE+".sd")	
-	print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_SAVING_OLD_CMDFILE, CMD_FILE, sourceRootPartition, CMD_FILE+".sd")
-	executeCommand(command)
+		with Phase("discovery"):
+			printMessage(MessageCatalog.MSG_DETECTED_PARTITIONS)
+			for partition in detectPartitions():
+				printMessage(MessageCatalog.MSG_DETECTED_PARTITION, partition[0], asReadable(partition[1]), asReadable(partition[2]), partition[3], partition[4], partition[5])
+			
+			eligibility = collectEligiblePartitions(args.force, convert, printMessage, rules)
+		
+		validTargetPartitions = eligibility.eligiblePartitions
+		sourceRootPartition = eligibility.sourceRootPartition
+
+		if len(validTargetPartitions) == 0:
+			printMessage(MessageCatalog.MSG_NO_ELIGIBLE_ROOT)
+			sys.exit(-1)
+		
+		printMessage(MessageCatalog.MSG_ELIGIBLES_AS_ROOT)
+		for partition in validTargetPartitions:
+			printMessage(MessageCatalog.MSG_ELIGIBLE_AS_ROOT, partition)
+			
+		inputAvailable = provisionedPartition in validTargetPartitions
+		selection = provisionedPartition
+		while not inputAvailable:	
+			selection = raw_input(MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_ENTER_PARTITION))
+			inputAvailable = selection in validTargetPartitions
+			if not inputAvailable:
+				printMessage(MessageCatalog.MSG_PARTITION_INVALIDE, selection)
+		
+		targetRootPartition = selection
+		
+		printMessage(MessageCatalog.MSG_PARTITION_WILL_BE_COPIED, sourceRootPartition, targetRootPartition)
+		if converter is not None and targetRootPartition != provisionedPartition:
+			printMessage(MessageCatalog.MSG_PARTITION_WILL_BE_FORMATTED, targetRootPartition, convert)
+		printMessage(MessageCatalog.MSG_ARE_YOU_SURE)
+		selection = raw_input('')
+		if selection not in ['Y', 'y', 'J', 'j']:
+			sys.exit(0)
 	
-	# update cmdline.txt	
-	command = "sed -i \"s|root=[^ ]\+|root=%s|g\" %s/%s" % (targetID, sourceDirectory, CMD_FILE)
-	print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_UPDATING_CMDFILE, CMD_FILE, targetRootPartition)
-	executeCommand(command)
+		if converter is not None and targetRootPartition != provisionedPartition:
+			converter.format(targetRootPartition, DeviceManager().getMountpoint(targetRootPartition))
+		
+		copyRootPartition(sourceRootPartition, targetRootPartition, args.seed_from, not args.notune, printMessage, rules)
+		bootConfiguration = updateBootConfiguration(sourceRootPartition, targetRootPartition, converter, printMessage)
+
+		if args.iotune:
+			tuneIOStack(targetRootPartition, DeviceManager().getMountpoint(targetRootPartition), bootConfiguration.cmdFile)
+		
+		printMessage(MessageCatalog.MSG_DONE, sourceRootPartition, targetRootPartition)
 	
-	print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_DONE, sourceRootPartition, targetRootPartition)
+	except KeyboardInterrupt as ex:
+		print 
+		pass	
 
-except KeyboardInterrupt as ex:
-	print 
-	pass	
+	except MigrationError as ex:
+		print ex
+		sys.exit(-1)
+	
+	except Exception as ex:
+		logger.error(traceback.format_exc())
+		printMessage(MessageCatalog.MSG_FAILURE, ex.message, logFile)
 
-except Exception as ex:
-	logger.error(traceback.format_exc())
-	print MessageCatalog.getLocalizedMessage(MessageCatalog.MSG_FAILURE, ex.message, LOG_FILENAME)
+if __name__ == "__main__":
+	main()